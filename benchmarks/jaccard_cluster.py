@@ -0,0 +1,88 @@
+"""Benchmark the CPU jaccard clustering against the original row by row loop on a near-threshold corpus
+
+The fingerprints are of families of sets, where the members of a family have a random fraction of the elements of
+ the family replaced, so that their similarities are spread around the threshold (the hardest case for banding).
+Both implementations must give the same clusters, and the run exits with an error if the clustering is slower than
+ the original loop.
+
+Usage: python benchmarks/jaccard_cluster.py [--n 2000 8000] [--threshold 0.5 0.9]
+"""
+import sys
+import time
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src' / 'intertext'))
+
+from vminhash import VectorizedMinHash, jaccard_cluster  # noqa: E402
+
+
+def make_fingerprints(n, n_perm, threshold, family_size, set_size, seed):
+    """Return the fingerprints of n sets in families with similarities around threshold"""
+    generator = np.random.RandomState(seed)
+    # the replaced fraction f of a member gives a similarity of (1 - f) / (1 + f) with its family set
+    max_fraction = min((1 - threshold) / (1 + threshold) * 2, 1)
+    sets = []
+    for _ in range(0, n, family_size):
+        family = generator.randint(0, 2 ** 32, size=set_size, dtype=np.uint64)
+        for _ in range(family_size):
+            member = family.copy()
+            replaced = generator.rand(set_size) < generator.uniform(0, max_fraction)
+            member[replaced] = generator.randint(0, 2 ** 32, size=replaced.sum(), dtype=np.uint64)
+            sets.append(member)
+    return VectorizedMinHash(n_perm=n_perm).fingerprints(sets[:n])
+
+
+def loop_cluster(capital_f, threshold):
+    """The original CPU clustering: compare each fingerprint with all later ones which are in other clusters"""
+    n = len(capital_f)
+    ids = np.arange(n)
+    cluster_ids = np.arange(n)
+    for i in range(n):
+        c_i = cluster_ids[i]
+        js = ids[i:][cluster_ids[i:] != c_i]
+        if len(js) == 0:
+            break
+        matched = np.count_nonzero(capital_f[js] == capital_f[i], axis=1) / capital_f.shape[1] >= threshold
+        if np.any(matched):
+            cluster_ids[np.isin(cluster_ids, np.unique(cluster_ids[js][matched]))] = c_i
+    # the first fingerprint of each cluster as its id (as jaccard_cluster)
+    _, first_ids, inverse = np.unique(cluster_ids, return_index=True, return_inverse=True)
+    return first_ids[inverse.reshape(-1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the CPU jaccard clustering on a near-threshold corpus',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--n', type=int, nargs='+', default=[2000, 8000], help='the numbers of fingerprints')
+    parser.add_argument('--threshold', type=float, nargs='+', default=[0.5, 0.9], help='the clustering thresholds')
+    parser.add_argument('--n_perm', type=int, default=128, help='the number of permutations')
+    parser.add_argument('--family_size', type=int, default=200, help='the number of sets per family')
+    parser.add_argument('--set_size', type=int, default=200, help='the number of elements per set')
+    parser.add_argument('--seed', type=int, default=1, help='the random seed of the synthetic sets')
+    args = parser.parse_args()
+
+    slower = False
+    print(f'{"n":>6} {"threshold":>9} {"clusters":>8} {"loop s":>8} {"cluster s":>9} {"speedup":>7}')
+    for n in args.n:
+        for threshold in args.threshold:
+            fingerprints = make_fingerprints(n, args.n_perm, threshold, args.family_size, args.set_size, args.seed)
+            start = time.perf_counter()
+            expected = loop_cluster(fingerprints, threshold)
+            loop_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            cluster_ids = jaccard_cluster(fingerprints, threshold, cuda=False)
+            seconds = time.perf_counter() - start
+            if not np.array_equal(cluster_ids, expected):
+                sys.exit(f'the clusters differ from the original loop (n={n}, threshold={threshold})')
+            slower |= seconds > loop_seconds
+            print(f'{n:>6} {threshold:>9} {len(np.unique(cluster_ids)):>8} {loop_seconds:>8.2f} {seconds:>9.2f} '
+                  f'{loop_seconds / seconds:>7.2f}')
+    if slower:
+        sys.exit('the clustering is slower than the original loop')
+
+
+if __name__ == '__main__':
+    main()
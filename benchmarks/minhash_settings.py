@@ -0,0 +1,85 @@
+"""Benchmark the recall/throughput/storage trade-off of the minhash settings on synthetic window pairs
+
+Usage: python benchmarks/minhash_settings.py [--n_pairs 2000]
+"""
+import sys
+import time
+import argparse
+from pathlib import Path
+from itertools import product
+from difflib import SequenceMatcher
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src' / 'intertext'))
+
+from vminhash import VectorizedMinHash, byte_hashes  # noqa: E402
+from minhash_files import get_hashbands, reduce_precision  # noqa: E402
+
+
+def make_window_pairs(n_pairs, window_length, seed):
+    """Return windows and their variants with a random number of replaced words"""
+    generator = np.random.RandomState(seed)
+    vocabulary = [''.join(generator.choice(list('abcdefghijklmnopqrstuvwxyz'), size=generator.randint(2, 10)))
+                  for _ in range(5000)]
+    windows, variants = [], []
+    for _ in range(n_pairs):
+        words = list(generator.choice(vocabulary, size=window_length))
+        variant = list(words)
+        for word_idx in generator.choice(window_length, size=generator.randint(0, window_length), replace=False):
+            variant[word_idx] = generator.choice(vocabulary)
+        windows.append(' '.join(words))
+        variants.append(' '.join(variant))
+    return windows, variants
+
+
+def run_setting(windows, variants, positives, chargram_length, hashband_length, hashband_step, n_perm, mirror,
+                one_permutation, minhash_bits):
+    """Return the throughput, storage, recall and false candidate rate of a minhash setting"""
+    hasher = VectorizedMinHash(n_perm=n_perm, mirror=mirror, one_permutation=one_permutation)
+    char_hashes = [byte_hashes(window.lower().encode('UTF-8'), n=chargram_length) for window in windows + variants]
+    start = time.perf_counter()
+    minhashes = reduce_precision(hasher.fingerprints(char_hashes), minhash_bits)
+    elapsed = time.perf_counter() - start
+    hashbands = [set(row) for row in get_hashbands(minhashes, hashband_length, hashband_step).tolist()]
+    n = len(windows)
+    candidates = np.array([len(hashbands[i] & hashbands[n + i]) > 0 for i in range(n)])
+    # unrelated pairs: each window with the variant of the next window
+    false_candidates = np.mean([len(hashbands[i] & hashbands[n + (i + 1) % n]) > 0 for i in range(n)])
+    return {'windows/s': len(char_hashes) / elapsed,
+            'bytes/window': minhashes.shape[1] * minhashes.itemsize,
+            'recall': candidates[positives].mean(),
+            'false candidates': false_candidates,
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the minhash settings on synthetic window pairs',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--n_pairs', type=int, default=2000, help='the number of window pairs')
+    parser.add_argument('--window_length', type=int, default=14, help='the length of windows in words')
+    parser.add_argument('--chargram_length', type=int, default=4, help='the number of characters per shingle')
+    parser.add_argument('--hashband_length', type=int, default=4, help='the number of minhash values per hashband')
+    parser.add_argument('--hashband_step', type=int, default=3, help='the number of minhash units to slide')
+    parser.add_argument('--min_sim', type=int, default=50, help='the minimum similarity of matching windows')
+    parser.add_argument('--seed', type=int, default=1, help='the random seed of the synthetic windows')
+    args = parser.parse_args()
+
+    windows, variants = make_window_pairs(args.n_pairs, args.window_length, args.seed)
+    # the pairs which the validation step would keep
+    positives = np.array([SequenceMatcher(a=a, b=b, autojunk=False).ratio() * 100 >= args.min_sim
+                          for a, b in zip(windows, variants)])
+    print(f' * {positives.sum()} of {len(positives)} window pairs have similarity >= {args.min_sim}')
+
+    print(f'{"n_perm":>6} {"mirror":>6} {"oph":>5} {"bits":>4} {"windows/s":>10} {"bytes/window":>12} {"recall":>7} '
+          f'{"false candidates":>16}')
+    for n_perm, mirror, one_permutation, minhash_bits in product((64, 128, 256), (False, True), (False, True),
+                                                                 (8, 16, 32)):
+        result = run_setting(windows, variants, positives, args.chargram_length, args.hashband_length,
+                             args.hashband_step, n_perm, mirror, one_permutation, minhash_bits)
+        print(f'{n_perm:>6} {mirror!s:>6} {one_permutation!s:>5} {minhash_bits:>4} {result["windows/s"]:>10.0f} '
+              f'{result["bytes/window"]:>12} {result["recall"]:>7.3f} {result["false candidates"]:>16.4f}')
+
+
+if __name__ == '__main__':
+    main()
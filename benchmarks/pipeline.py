@@ -0,0 +1,238 @@
+"""Benchmark the pipeline stages on a synthetic corpus with planted text reuse
+
+The corpus has n_files files of random (Zipf distributed) words. Passages of reused text (with some of their words
+ replaced) are planted between random file pairs, and boilerplate passages are planted into a fraction of all files.
+The pipeline is run on the corpus and the throughput of each stage (from output/api/metrics.json) and the recall of
+ the planted passages are reported, optionally compared to a saved baseline.
+
+Usage: python benchmarks/pipeline.py [--n_files 20] [--save_baseline baseline.json] [--baseline baseline.json]
+        [any intertext option, e.g. --one_permutation]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from collections import defaultdict
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'src' / 'intertext'))
+
+from config import parse  # noqa: E402
+from intertext_main import process_texts  # noqa: E402
+
+
+def make_corpus(corpus_dir, n_files, words_per_file, reuse_rate, passage_length, mutation_rate, n_boilerplate,
+                boilerplate_rate, seed):
+    """Write a synthetic corpus with metadata and return the planted passages
+
+    A planted passage is (file_id_a, start_a, file_id_b, start_b, length, is_boilerplate) in words, where the words
+     of file b were copied from file a (file ids are the indices of the sorted file names)
+    """
+    generator = np.random.RandomState(seed)
+    vocabulary = [''.join(generator.choice(list('abcdefghijklmnopqrstuvwxyz'), size=generator.randint(2, 12)))
+                  for _ in range(20000)]
+    # Zipf distributed word frequencies with the shortest words being the most frequent, as in natural language
+    vocabulary = np.array(sorted(vocabulary, key=len))
+    frequencies = 1 / np.arange(1, len(vocabulary) + 1)
+    files = [generator.choice(vocabulary, size=words_per_file, p=frequencies / frequencies.sum())
+             for _ in range(n_files)]
+    # the planted passages (and their sources) must not overlap, so the planted words stay intact
+    occupied = np.zeros((n_files, words_per_file), dtype=bool)
+    planted = []
+
+    def free_start(file_id):
+        for _ in range(100):
+            start = generator.randint(0, words_per_file - passage_length)
+            if not occupied[file_id, start:start + passage_length].any():
+                return start
+        return None
+
+    def plant(file_id_a, start_a, file_id_b, is_boilerplate):
+        start_b = free_start(file_id_b)
+        if start_b is None:
+            return None
+        words = files[file_id_a][start_a:start_a + passage_length].copy()
+        mutated = generator.rand(passage_length) < mutation_rate
+        words[mutated] = generator.choice(vocabulary, size=mutated.sum())
+        files[file_id_b][start_b:start_b + passage_length] = words
+        occupied[file_id_a, start_a:start_a + passage_length] = True
+        occupied[file_id_b, start_b:start_b + passage_length] = True
+        planted.append((file_id_a, start_a, file_id_b, start_b, passage_length, is_boilerplate))
+        return start_b
+
+    # boilerplate: a few passages repeated in many files (skewing the hashband and candidate distributions)
+    for _ in range(n_boilerplate):
+        file_id_a = generator.randint(n_files)
+        start_a = free_start(file_id_a)
+        if start_a is None:
+            continue
+        copies = []
+        for file_id_b in np.flatnonzero(generator.rand(n_files) < boilerplate_rate):
+            if file_id_b != file_id_a:
+                start_b = plant(file_id_a, start_a, file_id_b, True)
+                if start_b is not None:
+                    copies.append((file_id_b, start_b))
+        # the copies are reused text of each other as well
+        for copy_idx, (file_id_b, start_b) in enumerate(copies):
+            for file_id_c, start_c in copies[copy_idx + 1:]:
+                planted.append((file_id_b, start_b, file_id_c, start_c, passage_length, True))
+
+    # reuse: reuse_rate of all words are in passages copied from another file
+    for _ in range(int(reuse_rate * n_files * words_per_file / passage_length)):
+        file_id_a, file_id_b = generator.choice(n_files, size=2, replace=False)
+        start_a = free_start(file_id_a)
+        if start_a is not None:
+            plant(file_id_a, start_a, file_id_b, False)
+
+    corpus_dir.mkdir(parents=True, exist_ok=True)
+    metadata = {}
+    for file_id, words in enumerate(files):
+        lines = [' '.join(words[i:i + 10]) for i in range(0, len(words), 10)]
+        (corpus_dir / f'{file_id:05d}.txt').write_text('\n'.join(lines) + '\n', encoding='UTF-8')
+        metadata[f'{file_id:05d}.txt'] = {'author': f'Author {file_id % 7}', 'title': f'Text {file_id}',
+                                          'year': 1700 + file_id}
+    with open(corpus_dir.parent / 'metadata.json', 'w', encoding='UTF-8') as out:
+        json.dump(metadata, out)
+    return planted
+
+
+def evaluate(output, planted, window_length, slide_length):
+    """Return the recall of the planted passages (and boilerplate) and the fraction of matches on planted text"""
+    # the word ranges of the matches for each (ordered) file pair
+    matches = defaultdict(list)
+    n_matches = 0
+    for match_file in (output / 'api' / 'matches').glob('*.json'):
+        with open(match_file, encoding='UTF-8') as f:
+            for match in json.load(f):
+                if match['source_file_id'] != int(match_file.stem):
+                    continue  # each match is stored for both files
+                n_matches += 1
+                ranges = []
+                for side in ('source', 'target'):
+                    segment_ids = match[f'{side}_segment_ids']
+                    ranges.append((min(segment_ids) * slide_length, max(segment_ids) * slide_length + window_length))
+                matches[(match['source_file_id'], match['target_file_id'])].append(tuple(ranges))
+                matches[(match['target_file_id'], match['source_file_id'])].append(tuple(reversed(ranges)))
+
+    def overlaps(range_a, start, length):
+        return range_a[0] < start + length and start < range_a[1]
+
+    found = {False: [], True: []}
+    planted_matches = set()
+    for file_id_a, start_a, file_id_b, start_b, length, is_boilerplate in planted:
+        hits = [(range_a, range_b) for range_a, range_b in matches[(file_id_a, file_id_b)]
+                if overlaps(range_a, start_a, length) and overlaps(range_b, start_b, length)]
+        found[is_boilerplate].append(len(hits) > 0)
+        planted_matches.update((min(file_id_a, file_id_b), max(file_id_a, file_id_b), hit) for hit in hits)
+    return {'matches': n_matches,
+            'recall': float(np.mean(found[False])) if found[False] else None,
+            'boilerplate_recall': float(np.mean(found[True])) if found[True] else None,
+            'planted_match_fraction': len(planted_matches) / n_matches if n_matches > 0 else None,
+            }
+
+
+def run_benchmark(args, intertext_args):
+    """Generate the corpus, run the pipeline and return the throughput and recall results"""
+    with TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        planted = make_corpus(tmp_dir / 'texts', args.n_files, args.words_per_file, args.reuse_rate,
+                              args.passage_length, args.mutation_rate, args.n_boilerplate, args.boilerplate_rate,
+                              args.seed)
+        sys.argv = ['intertext', '--infiles', str(tmp_dir / 'texts' / '*.txt'), '--metadata',
+                    str(tmp_dir / 'metadata.json'), '--output', str(tmp_dir / 'output'), *intertext_args]
+        kwargs = parse()
+        # the cache is created in the working directory
+        cwd = os.getcwd()
+        os.chdir(tmp_dir)
+        try:
+            start = time.perf_counter()
+            process_texts(kwargs)
+            wall = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+        with open(tmp_dir / 'output' / 'api' / 'metrics.json', encoding='UTF-8') as f:
+            metrics = json.load(f)
+        results = evaluate(tmp_dir / 'output', planted, kwargs['window_length'], kwargs['slide_length'])
+
+    n_words = args.n_files * args.words_per_file
+    return {'corpus': {'n_files': args.n_files, 'words_per_file': args.words_per_file, 'reuse_rate': args.reuse_rate,
+                       'passage_length': args.passage_length, 'mutation_rate': args.mutation_rate,
+                       'n_boilerplate': args.n_boilerplate, 'boilerplate_rate': args.boilerplate_rate,
+                       'seed': args.seed, 'planted': len(planted)},
+            'intertext_args': intertext_args,
+            'wall_seconds': wall,
+            'words_per_second': n_words / wall,
+            'stages': {stage['name']: {'wall_seconds': stage['wall_seconds'],
+                                       'words_per_second': n_words / max(stage['wall_seconds'], 1e-9),
+                                       'peak_rss_mb': stage['peak_rss_mb'],
+                                       'rows_in': stage['rows_in'],
+                                       'rows_out': stage['rows_out']}
+                       for stage in metrics['stages']},
+            **results,
+            }
+
+
+def compare(results, baseline, max_slowdown, max_recall_drop):
+    """Print the results next to the baseline and return False if the results regressed"""
+    print(f'{"stage":>12} {"baseline s":>11} {"current s":>10} {"change":>7}')
+    for name, stage in results['stages'].items():
+        base = baseline['stages'].get(name)
+        if base is None:
+            print(f'{name:>12} {"-":>11} {stage["wall_seconds"]:>10.2f}')
+        else:
+            change = stage['wall_seconds'] / max(base['wall_seconds'], 1e-9)
+            print(f'{name:>12} {base["wall_seconds"]:>11.2f} {stage["wall_seconds"]:>10.2f} {change:>6.2f}x')
+    slowdown = results['wall_seconds'] / baseline['wall_seconds']
+    print(f'{"total":>12} {baseline["wall_seconds"]:>11.2f} {results["wall_seconds"]:>10.2f} {slowdown:>6.2f}x')
+
+    ok = slowdown <= max_slowdown
+    for key in ('recall', 'boilerplate_recall'):
+        if results[key] is not None and baseline.get(key) is not None:
+            print(f' * {key}: {baseline[key]:.3f} -> {results[key]:.3f}')
+            ok = ok and results[key] >= baseline[key] - max_recall_drop
+    if results['corpus'] != baseline['corpus'] or results['intertext_args'] != baseline['intertext_args']:
+        print(' * warning: the corpus or the intertext options differ from the baseline')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline on a synthetic corpus with planted reuse',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--n_files', type=int, default=20, help='the number of files')
+    parser.add_argument('--words_per_file', type=int, default=4000, help='the number of words per file')
+    parser.add_argument('--reuse_rate', type=float, default=0.05, help='the fraction of words in reused passages')
+    parser.add_argument('--passage_length', type=int, default=60, help='the length of planted passages in words')
+    parser.add_argument('--mutation_rate', type=float, default=0.1,
+                        help='the fraction of replaced words in the planted passages')
+    parser.add_argument('--n_boilerplate', type=int, default=3, help='the number of boilerplate passages')
+    parser.add_argument('--boilerplate_rate', type=float, default=0.5,
+                        help='the fraction of files containing each boilerplate passage')
+    parser.add_argument('--seed', type=int, default=1, help='the random seed of the synthetic corpus')
+    parser.add_argument('--save_baseline', type=Path, help='save the results as a baseline to this JSON file')
+    parser.add_argument('--baseline', type=Path, help='compare the results to this baseline JSON file')
+    parser.add_argument('--max_slowdown', type=float, default=1.25,
+                        help='the maximum total wall time relative to the baseline')
+    parser.add_argument('--max_recall_drop', type=float, default=0.01,
+                        help='the maximum decrease of recall relative to the baseline')
+    # the rest of the arguments are passed to intertext
+    args, intertext_args = parser.parse_known_args()
+
+    results = run_benchmark(args, intertext_args)
+    print(json.dumps(results, indent=2))
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w', encoding='UTF-8') as out:
+            json.dump(results, out, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline, encoding='UTF-8') as f:
+            baseline = json.load(f)
+        if not compare(results, baseline, args.max_slowdown, args.max_recall_drop):
+            print(' * regression compared to the baseline!')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,18 +19,34 @@ config = {
     'hashband_length': 4,
     'hashband_step': 3,
     'chargram_length': 4,  # TODO 1,2,4 byte length
+    'n_perm': 256,
+    'mirror': True,
+    'hash_family': 'universal',
+    'one_permutation': False,
+    'minhash_bits': 32,
     'banish_distance': 4,
     'min_sim': 50,
     'max_file_sim': None,
     'output': Path('output'),
     'cache_location': Path('cache'),
+    'query_index': None,
     'xml_page_tag': None,
     'xml_page_attr': None,
     'strip_diacritics': False,
     'verbose': False,
+    'profile': False,
+    'resume': False,
+    'processes': None,
+    'chunksize': None,
+    'memory_budget': None,
+    'shard_dir': None,
+    'shard_task_size': 16,
+    'shard_stale_seconds': 600,
     'update_metadata': False,
     'compute_probabilities': False,
     'bounter_size': 64,
+    'index_sort_size': 1024,
+    'page_size': 1000,
     'about_files_dir': None,
     'image_directory': None
 }
@@ -94,16 +110,33 @@ def parse():
                         help='the number of minhash units to slide hashband windows', required=False)
     parser.add_argument('--chargram_length', '-cl', type=int, default=config['chargram_length'],
                         help='the number of characters per character shingle', required=False)
+    parser.add_argument('--n_perm', type=int, default=config['n_perm'],
+                        help='the number of permutations (minhash values) per window', required=False)
+    parser.add_argument('--no_mirror', default=config['mirror'], dest='mirror',
+                        help='if specified, the max of the permutations is not kept besides the min (halves the '
+                             'minhash length)', required=False, action='store_false')
+    parser.add_argument('--hash_family', type=str, default=config['hash_family'],
+                        choices=('universal', 'multiply_shift'), help='the hash functions used for the permutations',
+                        required=False)
+    parser.add_argument('--one_permutation', default=config['one_permutation'],
+                        help='if specified, windows are fingerprinted with (densified) one permutation hashing',
+                        required=False, action='store_true')
+    parser.add_argument('--minhash_bits', type=int, default=config['minhash_bits'], choices=(8, 16, 32),
+                        help='the number of lowest bits of each minhash value to keep (smaller cache)', required=False)
     parser.add_argument('--banish_distance', '-bd', type=int, default=config['banish_distance'],
                         help='the graph distance to travel when banishing linked matches', required=False)
     parser.add_argument('--min_sim', '-s', type=check_min_sim, default=config['min_sim'],
                         help='the minimum similarity of matches to retain)', required=False)
     parser.add_argument('--max_file_sim', '-fs', type=int, default=config['max_file_sim'],
-                        help='the maximum similarity between two files such that matches are retained', required=False)
+                        help='the maximum similarity between two files (percentage of matching windows of the shorter '
+                             'file) such that matches are retained', required=False)
     parser.add_argument('--output', '-o', type=Path, default=config['output'], help='the output location',
                         required=False)
     parser.add_argument('--cache', '-c', type=Path, default=config['cache_location'], help='the cache location',
                         required=False)
+    parser.add_argument('--query_index', type=Path, default=config['query_index'],
+                        help='if specified, a query index of the corpus is saved to this directory (see README)',
+                        required=False)
     parser.add_argument('--xml_page_tag', type=str, default=config['xml_page_tag'],
                         help='if specified, urls can reference content within this tag')
     parser.add_argument('--xml_page_attr', type=str, default=config['xml_page_attr'],
@@ -114,11 +147,39 @@ def parse():
     parser.add_argument('--verbose', '-v', default=config['verbose'],
                         help='if specified, the intertext process will log more operations', required=False,
                         action='store_true')
+    parser.add_argument('--profile', default=config['profile'],
+                        help='if specified, each stage is profiled with cProfile (stats saved in cache/profiles)',
+                        required=False, action='store_true')
+    parser.add_argument('--resume', default=config['resume'],
+                        help='if specified, the finished work of an interrupted run with the same settings is kept',
+                        required=False, action='store_true')
+    parser.add_argument('--processes', type=int, default=config['processes'],
+                        help='the number of worker processes (default: the number of CPUs)', required=False)
+    parser.add_argument('--chunksize', type=int, default=config['chunksize'],
+                        help='the number of tasks sent to a worker process at once (default: chosen per stage)',
+                        required=False)
+    parser.add_argument('--memory_budget', type=int, default=config['memory_budget'],
+                        help='if specified, the number of processes, chunk size and cache sizes are tuned to fit '
+                             'into this many MB (see README)', required=False)
+    parser.add_argument('--shard_dir', type=Path, default=config['shard_dir'],
+                        help='if specified, the tasks are run through this shared directory by the workers of all '
+                             'nodes (see README)', required=False)
+    parser.add_argument('--shard_task_size', type=int, default=config['shard_task_size'],
+                        help='the number of files or file pairs per shard task', required=False)
+    parser.add_argument('--shard_stale_seconds', type=int, default=config['shard_stale_seconds'],
+                        help='the seconds after which the claimed tasks of dead shard workers are requeued',
+                        required=False)
     parser.add_argument('--update_metadata', default=config['update_metadata'],
                         help='skip all processing and only update the metadata for a plot', action='store_true')
     parser.add_argument('--compute_probabilities', default=config['compute_probabilities'],
                         help='compute the likelihood of strings in the corpus', action='store_true')
-    parser.add_argument('--bounter_size', default=config['bounter_size'], help='MB allocated to bounter instance',
+    parser.add_argument('--bounter_size', type=int, default=config['bounter_size'],
+                        help='MB allocated to exact word counts or to the bounter instance if they do not fit',
+                        required=False)
+    parser.add_argument('--index_sort_size', type=int, default=config['index_sort_size'],
+                        help='MB allocated to sorting match indices in memory before spilling to disk', required=False)
+    parser.add_argument('--page_size', type=int, default=config['page_size'],
+                        help='the number of entries per page of the paginated API files (0 disables pagination)',
                         required=False)
     parser.add_argument('--about_files_dir', default=config['about_files_dir'],
                         help='Directory where different lang about-HTML files are stored.', required=False)
@@ -154,9 +215,12 @@ def process_kwargs(kwargs):
     # get the focal text index number (if any) of the only file from which matches should be retained
     if len(kwargs.get('only_filename')) > 0:
         try:
-            kwargs['only_id'] = kwargs['infiles'].index(kwargs['only_filename'])
-        except IndexError:
+            kwargs['only_id'] = kwargs['infiles'].index(Path(kwargs['only_filename']))
+        except ValueError:
             raise argparse.ArgumentTypeError(f'{kwargs["only_filename"]} not in infiles!')
+        # only the hashbands shared with the only file are saved
+        if kwargs['query_index'] is not None:
+            raise argparse.ArgumentTypeError('--query_index can not be used with --only')
 
     # extract HTML files from about_files_dir if passed
     about_files_dir = kwargs['about_files_dir']
@@ -1,29 +1,71 @@
 import sqlite3
 from contextlib import contextmanager
 
+from profiling import sql_timer
+
 
 class SQLCache:
-    def __init__(self, db_name, db_dir, initialize=False, verbose=False):
+    def __init__(self, db_name, db_dir, initialize=False, verbose=False, settings=None, resume=False,
+                 cache_size_mb=None):
         self._db_name = db_name
         self._db_dir = db_dir
         self._verbose = verbose
+        self._cache_size_mb = cache_size_mb
+        self.resumed = False
         if initialize:
-            self._initialize_db_sql()
-
-    def _initialize_db_sql(self):
-        """Run all setup steps to create the database"""
+            self._initialize_db_sql(settings, resume)
+        else:
+            self._upgrade_db_sql()
+
+    def _initialize_db_sql(self, settings, resume):
+        """Run all setup steps to create the database (keep the one of a run with the same settings if resuming)"""
+        if resume:
+            if self._get_settings() == settings:
+                print(' * resuming the previous run from the cache')
+                self.resumed = True
+                return
+            print(' * no previous run with the same settings in the cache; starting from scratch')
         with self._connect() as db:
             cursor = db.cursor()
             cursor.execute('DROP TABLE IF EXISTS hashbands;')
             cursor.execute('DROP TABLE IF EXISTS candidates;')
             cursor.execute('DROP TABLE IF EXISTS matches;')
-            cursor.execute('CREATE TABLE hashbands (hashband TEXT, file_id INTEGER, window_id INTEGER);')
+            cursor.execute('DROP TABLE IF EXISTS progress;')
+            cursor.execute('DROP TABLE IF EXISTS settings;')
+            cursor.execute('CREATE TABLE hashbands (hashband INTEGER, file_id INTEGER, window_id INTEGER);')
             cursor.execute(
                 'CREATE TABLE candidates (file_id_a INTEGER, file_id_b INTEGER, window_id_a INTEGER, window_id_b '
                 'INTEGER, UNIQUE(file_id_a, file_id_b, window_id_a, window_id_b));')
             cursor.execute(
                 'CREATE TABLE matches (file_id_a INTEGER, file_id_b INTEGER, window_id_a INTEGER, window_id_b '
                 'INTEGER, similarity INTEGER);')
+            self._create_progress_sql(cursor)
+            cursor.execute('INSERT INTO settings (settings) VALUES (?);', (settings,))
+            db.commit()
+
+    def _upgrade_db_sql(self):
+        """Add the tables missing from a db created by an older version (e.g. when only updating the metadata)"""
+        with self._connect() as db:
+            self._create_progress_sql(db.cursor())
+            db.commit()
+
+    @staticmethod
+    def _create_progress_sql(cursor):
+        # the finished tasks of each stage (task '' marks a finished stage), to resume an interrupted run
+        cursor.execute('CREATE TABLE IF NOT EXISTS progress (stage TEXT, task TEXT, PRIMARY KEY (stage, task)) '
+                       'WITHOUT ROWID;')
+        cursor.execute('CREATE TABLE IF NOT EXISTS settings (settings TEXT);')
+
+    def _get_settings(self):
+        """Return the settings of the run which created the db (None if there is no such db)"""
+        if not (self._db_dir / f'{self._db_name}.db').exists():
+            return None
+        with self._connect() as db:
+            try:
+                row = db.execute('SELECT settings FROM settings;').fetchone()
+            except sqlite3.OperationalError:  # created before the settings were stored
+                return None
+        return row[0] if row is not None else None
 
     @contextmanager
     def _connect(self):
@@ -33,6 +75,8 @@ class SQLCache:
         db.execute('PRAGMA journal_mode = DELETE;')  # WAL is fastest
         db.execute('PRAGMA temp_store = 1;')
         db.execute(f'PRAGMA temp_store_directory = "{self._db_dir}"')
+        if self._cache_size_mb is not None:
+            db.execute(f'PRAGMA cache_size = -{int(self._cache_size_mb * 1024)};')  # in KiB if negative
         try:
             yield db
         finally:
@@ -43,35 +87,70 @@ class SQLCache:
         for i in self._db_dir.glob('*.db'):
             i.unlink()
 
-    def _generic_writer(self, query, writes, msg):
-        """Given a db cursor and list of write operations, execute each"""
+    def _generic_writer(self, query, writes, msg, done=()):
+        """Given a db cursor and list of write operations, execute each (and mark the [(stage, task)] done)"""
         if self._verbose:
             print(msg)
         # In case of error raises sqlite3.DatabaseError which of course should not happen
         with self._connect() as db:
             cursor = db.cursor()
             cursor.executemany(query, writes)
+            # the tasks are only marked done together with their results
+            cursor.executemany('INSERT OR IGNORE INTO progress (stage, task) VALUES (?,?);', done)
             db.commit()
 
-    def write_hashbands(self, writes):
+    @sql_timer
+    def write_hashbands(self, writes, done=()):
         self._generic_writer('INSERT INTO hashbands (hashband, file_id, window_id) VALUES (?,?,?);', writes,
-                             f' * writing {len(writes)} hashbands')
+                             f' * writing {len(writes)} hashbands', done)
 
+    @sql_timer
     def write_candidates(self, writes):
         self._generic_writer(
             'INSERT OR IGNORE INTO candidates (file_id_a, file_id_b, window_id_a, window_id_b) VALUES (?,?,?,?);',
             writes, f' * writing {len(writes)} candidates')
 
-    def write_matches(self, writes):
+    @sql_timer
+    def write_matches(self, writes, done=()):
         self._generic_writer(
             'INSERT INTO matches (file_id_a, file_id_b, window_id_a, window_id_b, similarity) VALUES (?,?,?,?,?);',
-            writes, f' * writing {len(writes)} matches')
-
-    def delete_matches(self, deletes):
-        """Given d[file_id] = [window_id], delete all specified windows"""
-        self._generic_writer(
-            'DELETE FROM matches WHERE file_id_a = (?) AND window_id_a = (?) OR file_id_b = (?) and window_id_b = (?);',
-            deletes, f' * deleting {len(deletes)} matches')
+            writes, f' * writing {len(writes)} matches', done)
+
+    @sql_timer
+    def mark_done(self, done):
+        """Given [(stage, task)], mark the tasks done (task '' marks the whole stage done)"""
+        self._generic_writer('INSERT OR IGNORE INTO progress (stage, task) VALUES (?,?);', done,
+                             f' * marking {len(done)} tasks done')
+
+    @sql_timer
+    def forget_done(self, stages):
+        """Given [(stage,)], forget the done tasks of the stages"""
+        self._generic_writer('DELETE FROM progress WHERE stage = ?;', stages,
+                             f' * forgetting the done tasks of {len(stages)} stages')
+
+    @sql_timer
+    def delete_matches(self, deletes, rebuild_fraction=0.5):
+        """Given [(file_id, window_id)], delete all matches of the specified windows"""
+        if self._verbose:
+            print(f' * deleting the matches of {len(deletes)} windows')
+        # matches that start or end with any of the deleted windows (anti-join on the indexed temporary table)
+        deleted = 'EXISTS (SELECT 1 FROM deletes WHERE file_id = file_id_a AND window_id = window_id_a) OR ' \
+                  'EXISTS (SELECT 1 FROM deletes WHERE file_id = file_id_b AND window_id = window_id_b)'
+        with self._connect() as db:
+            cursor = db.cursor()
+            cursor.execute('CREATE TEMP TABLE deletes (file_id INTEGER, window_id INTEGER, '
+                           'PRIMARY KEY (file_id, window_id)) WITHOUT ROWID;')
+            cursor.executemany('INSERT OR IGNORE INTO deletes (file_id, window_id) VALUES (?,?);', deletes)
+            n_matches, n_deleted = cursor.execute(f'SELECT COUNT(*), COUNT(*) FILTER (WHERE {deleted}) '
+                                                  f'FROM matches;').fetchone()
+            # rebuilding the table from the kept rows is cheaper than deleting most of them one by one
+            if n_deleted > n_matches * rebuild_fraction:
+                cursor.execute(f'CREATE TABLE matches_kept AS SELECT * FROM matches WHERE NOT ({deleted});')
+                cursor.execute('DROP TABLE matches;')
+                cursor.execute('ALTER TABLE matches_kept RENAME TO matches;')
+            elif n_deleted > 0:
+                cursor.execute(f'DELETE FROM matches WHERE {deleted};')
+            db.commit()
 
     def _generic_reader(self, query, params, msg):
         if self._verbose:
@@ -81,6 +160,7 @@ class SQLCache:
             for row in cursor.execute(query, params):
                 yield row
 
+    @sql_timer
     def stream_hashbands(self):
         """Stream [hashband, file_id, window_id] sorted by hashband"""
         return self._generic_reader("""WITH file_id_counts AS (SELECT hashband, COUNT(DISTINCT(file_id)) as count
@@ -90,29 +170,53 @@ class SQLCache:
                                        ORDER BY hashband;""", (),
                                     ' * querying for hashbands')
 
+    @sql_timer
+    def count_hashbands(self):
+        """Return the number of hashbands"""
+        return next(self._generic_reader('SELECT COUNT(*) FROM hashbands;', (), ' * counting hashbands'))[0]
+
+    @sql_timer
+    def stream_all_hashbands(self):
+        """Stream [hashband, file_id, window_id] for all hashbands sorted by hashband"""
+        return self._generic_reader('SELECT hashband, file_id, window_id FROM hashbands '
+                                    'ORDER BY hashband, file_id, window_id;', (),
+                                    ' * querying for all hashbands')
+
+    @sql_timer
     def stream_candidate_file_id_pairs(self):
         """Stream [file_id_a, file_id_b] pairs for files with matching hashbands"""
         return self._generic_reader(
            'SELECT DISTINCT file_id_a, file_id_b FROM candidates ORDER BY file_id_a, file_id_b;', (),
            ' * querying for candidate file id pairs')
 
-    def stream_matching_file_id_pairs(self):
-        """Stream [file_id_a, file_id_b] for file ids that have verified matches"""
-        return self._generic_reader('SELECT DISTINCT file_id_a, file_id_b FROM matches;', (),
+    @sql_timer
+    def stream_matching_file_id_pair_counts(self):
+        """Stream [file_id_a, file_id_b, count] for file ids that have verified matches sorted by file ids"""
+        return self._generic_reader('SELECT file_id_a, file_id_b, COUNT(*) FROM matches GROUP BY file_id_a, file_id_b '
+                                    'ORDER BY file_id_a, file_id_b;', (),
                                     ' * querying for matching file id pairs')
 
+    @sql_timer
     def stream_matching_candidate_windows(self, file_id_a, file_id_b):
         """Stream [file_id_a, file_id_b, window_id_a, window_id_b] for matching hashbands"""
         return self._generic_reader('SELECT DISTINCT file_id_a, file_id_b, window_id_a, window_id_b FROM candidates '
                                     'WHERE file_id_a = ? AND file_id_b = ? ORDER BY file_id_b;', (file_id_a, file_id_b),
                                     ' * querying for matching candidate windows')
 
+    @sql_timer
     def stream_file_pair_matches(self, file_id_a, file_id_b):
         """Stream [window_id_a, window_id_b, similarity] for a match pair in file_id_a and file_id_b"""
         return self._generic_reader('SELECT window_id_a, window_id_b, similarity FROM matches '
                                     'WHERE file_id_a = ? AND file_id_b = ?;', (file_id_a, file_id_b),
                                     ' * querying for file pair matches')
 
+    @sql_timer
+    def stream_done_tasks(self, stage):
+        """Stream [task] for the done tasks of a stage"""
+        return self._generic_reader('SELECT task FROM progress WHERE stage = ?;', (stage,),
+                                    ' * querying for done tasks')
+
+    @sql_timer
     def stream_all_pair_matches(self):
         """Stream [file_id_a, file_id_b, window_id_a, window_id_b, similarity] for all match pairs"""
         return self._generic_reader('SELECT * FROM matches;', (),
@@ -1,73 +1,95 @@
 import json
-from uuid import uuid4
 from pathlib import Path
 from collections import defaultdict
 
-from utils import get_words, get_windows, get_window_map, parallel_map
+from utils import get_words, get_windows, get_window_map, get_max_file_matches, parallel_map, file_cache
+from sharding import shard_reads
 
 
 # Only this function is public in this file!
 def format_all_matches(counts, metadata, infiles, strip_diacritics, xml_page_tag, xml_page_attr, window_length,
                        slide_length, min_sim, max_file_sim, excluded_file_ids, output, cache_db):
     """Format the match objects for each infile and store as JSON"""
-    pairs = ((file_id_a, file_id_b) for file_id_a, file_id_b in cache_db.stream_matching_file_id_pairs()
-             if file_id_a not in excluded_file_ids or file_id_b not in excluded_file_ids)
+    # skip the file pairs formatted by a previous (interrupted) run with the same settings
+    done = {row[0] for row in cache_db.stream_done_tasks('format')}
+    pairs = ((file_id_a, file_id_b, id_offset) for file_id_a, file_id_b, id_offset in get_match_id_offsets(cache_db)
+             if (file_id_a not in excluded_file_ids or file_id_b not in excluded_file_ids) and
+             f'{file_id_a}-{file_id_b}' not in done)
     parallel_map(format_file_matches, pairs, counts=counts, metadata=metadata, infiles=infiles,
                  strip_diacritics=strip_diacritics, xml_page_tag=xml_page_tag, xml_page_attr=xml_page_attr,
                  window_length=window_length, slide_length=slide_length, min_sim=min_sim, max_file_sim=max_file_sim,
                  output=output, cache_db=cache_db)
 
 
+def get_match_id_offsets(cache_db):
+    """Stream [file_id_a, file_id_b, id_offset] where id_offset is the first match id of the file pair"""
+    # a file pair has at most as many clusters as matching window pairs, so the cumulative match counts (in file id
+    #  order) give deterministic, compact and non-overlapping match id ranges for each file pair
+    id_offset = 0
+    for file_id_a, file_id_b, count in cache_db.stream_matching_file_id_pair_counts():
+        yield file_id_a, file_id_b, id_offset
+        id_offset += count
+
+
+@shard_reads(lambda pairs: [('stream_file_pair_matches', (pairs[0], pairs[1]))])
 def format_file_matches(pairs, counts, metadata, infiles, strip_diacritics, xml_page_tag, xml_page_attr,
                         window_length, slide_length, min_sim, max_file_sim, output, cache_db):
     """'Format the matches for a single file pair"""
-    file_id_a, file_id_b = pairs
+    file_id_a, file_id_b, id_offset = pairs
     pair_matches = list(cache_db.stream_file_pair_matches(file_id_a, file_id_b))
     len_pair_matches = len(pair_matches)
     if len_pair_matches > 0:
         # check to see if this file pair has >= max allowed similarity
         a_windows = get_windows(infiles[file_id_a], strip_diacritics, window_length, slide_length)
         b_windows = get_windows(infiles[file_id_b], strip_diacritics, window_length, slide_length)
-        if max_file_sim is not None and ((len_pair_matches > len(a_windows) * max_file_sim) or
-                                         (len_pair_matches > len(b_windows) * max_file_sim)):
+        max_file_matches = get_max_file_matches(len(a_windows), len(b_windows), max_file_sim)
+        if max_file_matches is not None and len_pair_matches > max_file_matches:
             print(' * file pair', file_id_a, file_id_b, 'has >= max_file_sim; skipping!')
+            cache_db.mark_done([('format', f'{file_id_a}-{file_id_b}')])
             return
         # cluster the matches so sequential matching windows are grouped into a single match
-        clusters = []
-        window_a, window_b, sims = zip(*pair_matches)
-        d = defaultdict(lambda: {})
-        for a, b, sim in pair_matches:
-            d[a][b] = sim
-        for a in get_sequences(window_a):
-            for b in get_sequences(window_b):
-                cluster = {'a': set(), 'b': set(), 'sim': []}
-                for a_i in a:
-                    for b_i in b:
-                        sim = d[a_i].get(b_i)
-                        if sim is not None:
-                            cluster['a'].add(a_i)
-                            cluster['b'].add(b_i)
-                            cluster['sim'].append(sim)
-                if len(cluster['a']) > 0:  # len(cluster['b']) > 0 is also true as they are simultaneously filled
-                    sim_avg = int(sum(cluster['sim']) / len(cluster['sim']))
-                    if sim_avg >= min_sim:
-                        clusters.append({'a': sorted(cluster['a']),
-                                         'b': sorted(cluster['b']),
-                                         'sim': sim_avg,
-                                         })
+        clusters = get_clusters(pair_matches, min_sim)
         # format the matches, then save into both file_id_a and file_id_b directories
-        formatted = format_matches(file_id_a, file_id_b, clusters, counts, metadata,
+        formatted = format_matches(file_id_a, file_id_b, id_offset, clusters, counts, metadata,
                                    Path(infiles[file_id_a]), Path(infiles[file_id_b]),
                                    strip_diacritics, xml_page_tag, xml_page_attr, window_length, slide_length)
         for curr_file_id in (file_id_a, file_id_b):  # write twice per match
             out_filename = output / 'api' / 'matches' / str(curr_file_id) / f'{file_id_a}-{file_id_b}.json'
             with open(out_filename, 'w', encoding='UTF-8') as out:
                 json.dump(formatted, out, ensure_ascii=False)
+        cache_db.mark_done([('format', f'{file_id_a}-{file_id_b}')])
+
 
+def get_clusters(pair_matches, min_sim):
+    """Given [window_id_a, window_id_b, similarity] group sequential matching windows into clusters {a: [], b: [], sim}"""
+    clusters = []
+    window_a, window_b, sims = zip(*pair_matches)
+    d = defaultdict(lambda: {})
+    for a, b, sim in pair_matches:
+        d[a][b] = sim
+    for a in get_sequences(window_a):
+        for b in get_sequences(window_b):
+            cluster = {'a': set(), 'b': set(), 'sim': []}
+            for a_i in a:
+                for b_i in b:
+                    sim = d[a_i].get(b_i)
+                    if sim is not None:
+                        cluster['a'].add(a_i)
+                        cluster['b'].add(b_i)
+                        cluster['sim'].append(sim)
+            if len(cluster['a']) > 0:  # len(cluster['b']) > 0 is also true as they are simultaneously filled
+                sim_avg = int(sum(cluster['sim']) / len(cluster['sim']))
+                if sim_avg >= min_sim:
+                    clusters.append({'a': sorted(cluster['a']),
+                                     'b': sorted(cluster['b']),
+                                     'sim': sim_avg,
+                                     })
+    return clusters
 
-def format_matches(file_id_a, file_id_b, clusters, counts, metadata, path_a, path_b, strip_diacritics, xml_page_tag,
-                   xml_page_attr, window_length, slide_length):
-    """Given integer file ids and clusters [{a: [], b: [], sim: []}] format matches for display"""
+
+def format_matches(file_id_a, file_id_b, id_offset, clusters, counts, metadata, path_a, path_b, strip_diacritics,
+                   xml_page_tag, xml_page_attr, window_length, slide_length):
+    """Given integer file ids, the first match id and clusters [{a: [], b: [], sim: []}] format matches for display"""
     bn_a = path_a.name
     bn_b = path_b.name
     a_meta = metadata[bn_a]
@@ -81,6 +103,10 @@ def format_matches(file_id_a, file_id_b, clusters, counts, metadata, path_a, pat
     a_words = get_words(path_a, strip_diacritics, True)
     b_words = get_words(path_b, strip_diacritics, True)
     formatted = []
+    # fetch the cumulative probabilities of the words if necessary
+    if counts is not None:
+        a_prefix_sums = get_probability_prefix_sums(path_a, strip_diacritics, counts)
+        b_prefix_sums = get_probability_prefix_sums(path_b, strip_diacritics, counts)
     # fetch a mapping from window id to $PAGE elements if necessary
     a_windows_to_page = None
     b_windows_to_page = None
@@ -91,17 +117,17 @@ def format_matches(file_id_a, file_id_b, clusters, counts, metadata, path_a, pat
         except:
             print(' * unable to retrieve mapping from window to page id')
     # each member c in clusters is a dictionary {a: b: } where values contain the match windows
-    for c in clusters:
+    for cluster_idx, c in enumerate(clusters):
         a_strings = get_match_strings(a_words, c['a'], window_length, slide_length)
         b_strings = get_match_strings(b_words, c['b'], window_length, slide_length)
         if counts is not None:
             # return the maximum probability of s1 and s2 as a float
-            probs_a = sum(counts[w] / counts.total() for w in a_strings['match'].split())
-            probs_b = sum(counts[w] / counts.total() for w in b_strings['match'].split())
+            probs_a = get_match_probability(a_prefix_sums, c['a'], window_length, slide_length)
+            probs_b = get_match_probability(b_prefix_sums, c['b'], window_length, slide_length)
             prob = round(max(probs_a, probs_b), 3) * 1000
         else:
             prob = -1
-        formatted.append({'_id': str(uuid4()),
+        formatted.append({'_id': id_offset + cluster_idx,
                           'similarity': c['sim'],
                           'probability': prob,
                           'source_file_id': file_id_a,
@@ -135,14 +161,36 @@ def get_url(meta, windows_to_page, windows, xml_page_tag):
     """Return the url to the first of the current windows"""
     ret = meta.get('url', '')
     if xml_page_tag:
-        ret = ret.replace('$PAGE_ID', windows_to_page.get(windows[0], ''))
+        page_id = ''
+        if windows_to_page is not None:
+            page_ids, window_pages = windows_to_page
+            if windows[0] < len(window_pages) and window_pages[windows[0]] >= 0:
+                page_id = page_ids[window_pages[windows[0]]]
+        ret = ret.replace('$PAGE_ID', page_id)
     return ret
 
 
+@file_cache
+def get_probability_prefix_sums(path, strip_diacritics, counts):
+    """Return the cumulative probabilities of the words of a file as displayed in the matches"""
+    return counts.prefix_sums(get_words(path, strip_diacritics, True))
+
+
+def get_match_probability(prefix_sums, window_ids, window_length, slide_length):
+    """Given the cumulative probabilities of the words and window ids, return the summed probability of a match"""
+    start, end = get_match_span(window_ids, window_length, slide_length)
+    n_words = len(prefix_sums) - 1
+    return prefix_sums[min(end, n_words)] - prefix_sums[min(start, n_words)]
+
+
+def get_match_span(window_ids, window_length, slide_length):
+    """Given window ids, return the start and end word ids of a match"""
+    return min(window_ids) * slide_length, max(window_ids) * slide_length + window_length
+
+
 def get_match_strings(words, window_ids, window_length, slide_length):
     """Given a list of words and window ids, format prematch, match, and postmatch strings for a match"""
-    start = min(window_ids) * slide_length
-    end = max(window_ids) * slide_length + window_length
+    start, end = get_match_span(window_ids, window_length, slide_length)
     return {
         'prematch': ' '.join(words[max(0, start - window_length):start]).lstrip('<br/>'),
         'match': ' '.join(words[start:end]),
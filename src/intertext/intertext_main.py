@@ -2,14 +2,17 @@ import json
 from pathlib import Path
 from shutil import rmtree, copytree
 
-from bounter import bounter
-from networkx import all_pairs_shortest_path_length, Graph
-from networkx.algorithms.components.connected import connected_components
+import numpy as np
 
-from utils import get_words
+from utils import get_words, parallel_map, chunked_iterator, start_pool, share, stop_pool, set_file_cache_size
 from db_sql import SQLCache
 from config import parse, process_kwargs
+from profiling import start_report, stage, write_report, record_tuning
+from sharding import start_sharding
+from memory import tune_memory
+from word_counts import get_word_counts
 from minhash_files import get_all_hashbands
+from query_index import INDEX_SETTINGS, build_query_index
 from format_matches import format_all_matches
 from json_output import create_all_match_json
 from validate_matches import validate_all_matches
@@ -19,11 +22,14 @@ from match_candidates import get_all_match_candidates
 """
 TODO:
   * add flag to indicate if same-author matches are allowed
-  * if resuming, process output/config.json to get the files and file ids
   @PG:
   * Handling words containing punctuations only
 """
 
+# the settings which do not change the results of a run
+RUNTIME_SETTINGS = ('resume', 'verbose', 'profile', 'query_index', 'update_metadata', 'processes', 'chunksize',
+                    'memory_budget', 'shard_dir', 'shard_task_size', 'shard_stale_seconds')
+
 
 # This is main()!
 def process_texts(kwargs):
@@ -35,60 +41,130 @@ def process_texts(kwargs):
     # get the metadata (if any)
     kwargs['metadata'] = get_metadata(kwargs['infiles'], kwargs['metadata'])
 
+    # size the worker pool, the chunks and the caches to fit the memory budget if requested
+    run_settings = get_run_settings(kwargs)
+    tuning = None
+    if kwargs['memory_budget'] is not None:
+        tuning = tune_memory(kwargs['memory_budget'], kwargs['infiles'], kwargs['processes'], kwargs['chunksize'],
+                             kwargs['bounter_size'], kwargs['index_sort_size'], kwargs['strip_diacritics'],
+                             kwargs['window_length'], kwargs['slide_length'], kwargs['chargram_length'],
+                             kwargs['n_perm'], kwargs['mirror'], kwargs['hash_family'], kwargs['one_permutation'],
+                             kwargs['minhash_bits'])
+        kwargs.update({key: tuning[key] for key in ('processes', 'chunksize', 'bounter_size', 'index_sort_size')})
+        set_file_cache_size(tuning['file_cache_size'])
+
+    # create the db (or keep the one of the previous run with the same settings if resuming)
+    kwargs['cache_location'].mkdir(parents=True, exist_ok=True)
+    cache_db = SQLCache('cache', db_dir=kwargs['cache_location'], initialize=not kwargs.get('update_metadata'),
+                        verbose=kwargs['verbose'], settings=run_settings, resume=kwargs['resume'],
+                        cache_size_mb=tuning['sqlite_cache_mb'] if tuning is not None else None)
+    # the formatted file pairs of the previous run are only kept if resuming before they were combined
+    keep_output = cache_db.resumed and len(get_done_tasks('format', cache_db)) > 0
+    if not keep_output:
+        cache_db.forget_done([('format',)])
+
     # create the output directories where results will be stored
     prepare_output_directories(kwargs['output'], kwargs['cache_location'], kwargs['infiles'], kwargs['about_files_dir'],
-                               kwargs['image_directory'])
+                               kwargs['image_directory'], keep_output)
+
+    # record the metrics of each stage (and optionally profile them)
+    start_report(kwargs['cache_location'] / 'profiles' if kwargs['profile'] else None, kwargs['verbose'])
+    if tuning is not None:
+        record_tuning(tuning)
+
+    # run the tasks through task files claimed by the workers of all nodes if requested
+    if kwargs['shard_dir'] is not None:
+        start_sharding(kwargs['shard_dir'], kwargs['shard_task_size'], kwargs['shard_stale_seconds'])
+    else:
+        # all stages use the same worker processes, which get the large read-only arguments only once
+        start_pool(kwargs['processes'], kwargs['chunksize'], kwargs['memory_budget'], infiles=kwargs['infiles'],
+                   metadata=kwargs['metadata'])
 
     # update the metadata and exit if requested
     if not kwargs.get('update_metadata'):
-        # create the db
-        cache_db = SQLCache('cache', initialize=True, db_dir=kwargs['cache_location'], verbose=kwargs['verbose'])
-
         # minhash files & store hashbands in db
         print(' * creating minhashes')
-        get_all_hashbands(kwargs['infiles'], kwargs['cache_location'], kwargs['strip_diacritics'],
-                          kwargs['window_length'], kwargs['slide_length'], kwargs['chargram_length'],
-                          kwargs['hashband_length'], kwargs['hashband_step'], cache_db)
+        with stage('minhash'):
+            get_all_hashbands(kwargs['infiles'], kwargs['cache_location'], kwargs['strip_diacritics'],
+                              kwargs['window_length'], kwargs['slide_length'], kwargs['chargram_length'],
+                              kwargs['hashband_length'], kwargs['hashband_step'], kwargs['n_perm'], kwargs['mirror'],
+                              kwargs['hash_family'], kwargs['one_permutation'], kwargs['minhash_bits'],
+                              kwargs['only_id'], cache_db)
+
+        # save the hashbands as an index to match new texts against the corpus later
+        if kwargs['query_index'] is not None:
+            with stage('query_index'):
+                build_query_index(kwargs['query_index'], kwargs['infiles'], kwargs['metadata'],
+                                  {setting: kwargs[setting] for setting in INDEX_SETTINGS}, cache_db)
 
         # find all hashbands that have multiple distict file_ids
         print(' * identifying match candidates')
-        get_all_match_candidates(kwargs['only_id'], cache_db, kwargs['verbose'])
+        if '' not in get_done_tasks('candidates', cache_db):
+            with stage('candidates'):
+                get_all_match_candidates(kwargs['only_id'], kwargs['excluded_file_ids'], cache_db, kwargs['verbose'])
+            cache_db.mark_done([('candidates', '')])
 
         # validate matches from among the candidates
         print(' * validating matches')
-        validate_all_matches(kwargs['infiles'], kwargs['strip_diacritics'], kwargs['window_length'],
-                             kwargs['slide_length'], kwargs['min_sim'], cache_db)
-    else:
-        cache_db = SQLCache('cache', db_dir=kwargs['cache_location'], verbose=kwargs['verbose'])
+        with stage('validate'):
+            validate_all_matches(kwargs['infiles'], kwargs['strip_diacritics'], kwargs['window_length'],
+                                 kwargs['slide_length'], kwargs['min_sim'], kwargs['max_file_sim'],
+                                 len(kwargs['banished_file_ids']) > 0, cache_db)
 
     # banish matches if necessary
-    if len(kwargs['banished_file_ids']) > 0:
-        banish_matches(kwargs['banished_file_ids'], kwargs['banish_distance'], cache_db)
+    if len(kwargs['banished_file_ids']) > 0 and '' not in get_done_tasks('banish', cache_db):
+        with stage('banish'):
+            banish_matches(kwargs['banished_file_ids'], kwargs['banish_distance'], cache_db)
+        cache_db.mark_done([('banish', '')])
 
     # format matches into JSON for client consumption
     print(' * formatting matches')
     # obtain global counts of terms across corpus
     counts = None
     if kwargs['compute_probabilities']:
-        counts = get_word_counts(kwargs['infiles'], kwargs['bounter_size'], kwargs['strip_diacritics'])
+        with stage('word_counts'):
+            counts = get_word_counts(kwargs['infiles'], kwargs['bounter_size'], kwargs['strip_diacritics'])
+        share(counts=counts)
 
-    format_all_matches(counts, kwargs['metadata'], kwargs['infiles'], kwargs['strip_diacritics'],
-                       kwargs['xml_page_tag'], kwargs['xml_page_attr'], kwargs['window_length'], kwargs['slide_length'],
-                       kwargs['min_sim'], kwargs['max_file_sim'], kwargs['excluded_file_ids'], kwargs['output'],
-                       cache_db)
+    with stage('format'):
+        format_all_matches(counts, kwargs['metadata'], kwargs['infiles'], kwargs['strip_diacritics'],
+                           kwargs['xml_page_tag'], kwargs['xml_page_attr'], kwargs['window_length'],
+                           kwargs['slide_length'], kwargs['min_sim'], kwargs['max_file_sim'],
+                           kwargs['excluded_file_ids'], kwargs['output'], cache_db)
 
-    # combine all matches into a single match object
+    # combine all matches into a single match object (the formatted file pairs are combined, so they are not done)
     print(' * formatting JSON outputs')
-    create_all_match_json(kwargs['output'], kwargs['compute_probabilities'])
+    cache_db.forget_done([('format',)])
+    with stage('json_output'):
+        create_all_match_json(kwargs['output'], kwargs['compute_probabilities'], kwargs['cache_location'],
+                              kwargs['index_sort_size'], kwargs['page_size'])
 
     # write the output config file
     print(' * writing config')
-    write_config(kwargs['infiles'], kwargs['metadata'], kwargs['excluded_file_ids'], kwargs['banished_file_ids'],
-                 kwargs['output'], kwargs['window_length'], kwargs['slide_length'], kwargs['about_files'])
+    with stage('config'):
+        write_config(kwargs['infiles'], kwargs['metadata'], kwargs['excluded_file_ids'], kwargs['banished_file_ids'],
+                     kwargs['output'], kwargs['window_length'], kwargs['slide_length'], kwargs['about_files'])
 
     # copy input texts into outputs
     print(' * preparing text reader data')
-    create_reader_data(kwargs['infiles'], kwargs['strip_diacritics'], kwargs['output'])
+    with stage('reader_data'):
+        create_reader_data(kwargs['infiles'], kwargs['strip_diacritics'], kwargs['output'])
+
+    stop_pool()
+
+    # write the metrics of the stages next to the output config file
+    write_report(kwargs['output'] / 'api' / 'metrics.json')
+
+
+def get_run_settings(kwargs):
+    """Return the settings of the run as JSON, a previous run can only be resumed with the same settings"""
+    return json.dumps({key: value for key, value in kwargs.items() if key not in RUNTIME_SETTINGS}, sort_keys=True,
+                      default=str)
+
+
+def get_done_tasks(stage_name, cache_db):
+    """Return the set of the done tasks of a stage (task '' marks the whole stage done)"""
+    return {row[0] for row in cache_db.stream_done_tasks(stage_name)}
 
 
 def get_metadata(infiles, metadata):
@@ -108,21 +184,21 @@ def get_metadata(infiles, metadata):
     return metadata
 
 
-def prepare_output_directories(output, cache_location, infiles, about_files_dir, image_directory):
-    """Create the folders that store output objects"""
+def prepare_output_directories(output, cache_location, infiles, about_files_dir, image_directory, keep_output=False):
+    """Create the folders that store output objects (the extant ones are kept if keep_output)"""
     # Copy the client to the output directory
-    if output.exists():
+    if output.exists() and not keep_output:
         rmtree(output)
     # copy the `build` directory to the output directory
-    copytree(Path(__file__).parent / 'client' / 'build', output)
+    copytree(Path(__file__).parent / 'client' / 'build', output, dirs_exist_ok=True)
 
     # copy the 'about_files_dir' directory to the api directory if passed (error handling done in process_kwargs)
     if about_files_dir is not None:
-        copytree(about_files_dir, output / 'api' / 'about')
+        copytree(about_files_dir, output / 'api' / 'about', dirs_exist_ok=True)
 
     # copy the 'image_directory' directory to the api directory if passed (error handling done in process_kwargs)
     if image_directory is not None:
-        copytree(image_directory, output / 'api' / 'images')
+        copytree(image_directory, output / 'api' / 'images', dirs_exist_ok=True)
 
     for i in ('matches', 'scatterplots', 'indices', 'texts'):
         (output / 'api' / i).mkdir(parents=True, exist_ok=True)
@@ -137,31 +213,34 @@ def prepare_output_directories(output, cache_location, infiles, about_files_dir,
 def banish_matches(banished_file_ids, banish_distance, cache_db):
     """Delete banished matches from the db"""
     print(' * banishing matches')
-    g = Graph()
-    for file_id_a, file_id_b, window_a, window_b, sim in cache_db.stream_all_pair_matches():
-        g.add_edge((file_id_a, window_a), (file_id_b, window_b))  # edges between file_id and windows pairs
-    # create list of banished windows to be deleted
-    deletes = []
-    distances = dict(all_pairs_shortest_path_length(g))
-    for graph_component in list(connected_components(g)):
-        banished_nodes = [graph_node for graph_node in graph_component if graph_node[0] in banished_file_ids]
-        # search up to maximum path length between nodes so nodes linked to a banished node are removed
-        for graph_node in graph_component:
-            if any(distances[graph_node][banished_node] < banish_distance for banished_node in banished_nodes):
-                deletes.append((graph_node[0], graph_node[1], graph_node[0], graph_node[1]))
+    # edges between (file_id, window_id) node pairs, with the nodes encoded as file_id << 32 | window_id
+    node_a, node_b = [], []
+    for rows in chunked_iterator(cache_db.stream_all_pair_matches(), 10 ** 6):
+        file_id_a, file_id_b, window_a, window_b, _ = np.array(rows, dtype=np.int64).T
+        node_a.append((file_id_a << 32) | window_a)
+        node_b.append((file_id_b << 32) | window_b)
+    if len(node_a) == 0:
+        return
+    nodes, edges = np.unique(np.concatenate(node_a + node_b), return_inverse=True)
+    edges = edges.reshape(2, -1)
+    # compressed sparse row adjacency of the undirected graph
+    sources = np.concatenate((edges[0], edges[1]))
+    neighbours = np.concatenate((edges[1], edges[0]))[np.argsort(sources, kind='stable')]
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(sources, minlength=len(nodes)))))
+    # multi-source BFS from the banished nodes, so nodes closer than banish_distance to a banished node are removed
+    visited = np.isin(nodes >> 32, banished_file_ids) & (banish_distance > 0)
+    frontier = np.flatnonzero(visited)
+    for _ in range(banish_distance - 1):
+        if len(frontier) == 0:
+            break
+        starts, lengths = indptr[frontier], indptr[frontier + 1] - indptr[frontier]
+        positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        frontier = np.unique(neighbours[positions])
+        frontier = frontier[~visited[frontier]]
+        visited[frontier] = True
     # remove the banished file_id, window_id tuples (which matches start or end with) from the db
-    cache_db.delete_matches(deletes)
-
-
-def get_word_counts(infiles, bounter_size, strip_diacritics):
-    """Return a bounter.bounter instance if user requested string likelihoods"""
-    print(' * computing word counts')
-    counts = bounter(size_mb=bounter_size)
-    for ifnile in infiles:
-        words = get_words(ifnile, strip_diacritics, False)
-        counts.update(words)
-    print(' * finished computing word counts')
-    return counts
+    deletes = nodes[visited]
+    cache_db.delete_matches(list(zip((deletes >> 32).tolist(), (deletes & (2 ** 32 - 1)).tolist())))
 
 
 def write_config(infiles, inp_metadata, excluded_file_ids, banished_file_ids, output, window_length, slide_length,
@@ -195,10 +274,15 @@ def write_config(infiles, inp_metadata, excluded_file_ids, banished_file_ids, ou
 
 def create_reader_data(infiles, strip_diacritics, output):
     """Create the data to be used in the reader view"""
-    for idx, infile in enumerate(infiles):
-        words = get_words(infile, strip_diacritics, True)
-        with open(output / 'api' / 'texts' / f'{idx}.json', 'w', encoding='UTF-8') as out:
-            json.dump(words, out, ensure_ascii=False)
+    parallel_map(write_reader_data, enumerate(infiles), strip_diacritics=strip_diacritics, output=output)
+
+
+def write_reader_data(args, strip_diacritics, output):
+    """Write the reader view data of a single file"""
+    idx, infile = args
+    words = get_words(infile, strip_diacritics, True)
+    with open(output / 'api' / 'texts' / f'{idx}.json', 'w', encoding='UTF-8') as out:
+        json.dump(words, out, ensure_ascii=False)
 
 
 if __name__ == '__main__':
@@ -1,107 +1,226 @@
 import json
+from heapq import merge
 from pathlib import Path
 from shutil import rmtree
+from operator import itemgetter
 from collections import defaultdict
+from tempfile import TemporaryDirectory
+
+import numpy as np
+
+from utils import chunked_iterator
+
+# the fields of the minimal representation of a match (the first 6 are written into the indices)
+#  0: match idx, 1: source_file_id, 2: target_file_id, 3: length, 4: probability, 5: similarity, 6: author, 7: title,
+#  8: year
+INDEX_FIELDS = ('match_idx', 'source_file_id', 'target_file_id', 'length', 'probability', 'similarity', 'author',
+                'title', 'year')
 
 
 # Only this function is public in this file!
-def create_all_match_json(output, compute_probabilities):
+def create_all_match_json(output, compute_probabilities, cache_location, index_sort_size, page_size):
     """Create the output JSON to be consumed by the web client"""
     # combine all the matches in each match directory into a composite match file
-    guid_to_int = defaultdict(lambda: len(guid_to_int))  # 0, 1, 2, 3, etc. in access order
-    for match_directory in (output / 'api' / 'matches').glob('*'):
+    for match_directory in list((output / 'api' / 'matches').glob('*')):
         # buff contains the flat list of matches for a single input file
         match_pairs = []
         for match_pair_json in match_directory.glob('*.json'):
             with open(match_pair_json, encoding='UTF-8') as fh:
-                json_match_pairs = json.load(fh)
-            for match in json_match_pairs:
-                match['_id'] = guid_to_int[match['_id']]
-                match_pairs.append(match)
-        with open(f'{match_directory}.json', 'w', encoding='UTF-8') as out:
-            json.dump(match_pairs, out, ensure_ascii=False)
+                match_pairs.extend(json.load(fh))
+        # the pages (if any) are written into the place of the per file pair match directory
         rmtree(match_directory)
-
-    # create minimal representations of all matches to be sorted by each sort heuristic below
-    buff = set()
-    for file_id, matches in stream_match_lists(output):
-        for match_idx, match in enumerate(matches):
-            if file_id == match.get('source_file_id'):
-                buff.add((match_idx,
-                          match['source_file_id'],
-                          match['target_file_id'],
-                          min(len(match['source_segment_ids']), len(match['target_segment_ids'])),
-                          match['probability'],
-                          match['similarity'],
-                          match['source_author'],
-                          match['source_title'],
-                          # only year can by empty
-                          match.get('source_year', ''),
-                          ))
+        write_json_list(Path(f'{match_directory}.json'), match_pairs, page_size)
 
     # create and store the file_id.match_index indices for each sort heuristic
-    # 3: length, 4: probability, 5: similarity, 6: author, 7: title, 8: year,
-    # 1: source_file_id, 2: target_file_id, 0: match idx
-    sort_heuristic = [('length', True, lambda x: (x[3], x[4], x[5], x[6], x[7], x[8], x[1], x[2], x[0])),
-                      ('probability', True, lambda x: (x[4], x[3], x[5], x[6], x[7], x[8], x[1], x[2], x[0])),
-                      ('similarity', True, lambda x: (x[5], x[3], x[4], x[6], x[7], x[8], x[1], x[2], x[0])),
-                      ('author', False, lambda x: (x[6], x[3], x[4], x[5], x[7], x[8], x[1], x[2], x[0])),
-                      ('title', False, lambda x: (x[7], x[3], x[4], x[5], x[6], x[8], x[1], x[2], x[0])),
-                      ('year', False, lambda x: (x[8], x[3], x[4], x[5], x[6], x[7], x[1], x[2], x[0])),
+    write_match_indices(output, compute_probabilities, cache_location, index_sort_size, page_size)
+
+    # create the scatterplot data
+    write_scatterplots(output, page_size)
+
+
+def write_match_indices(output, compute_probabilities, cache_location, index_sort_size, page_size):
+    """Sort the minimal representations of all matches by each sort heuristic and write the index files"""
+    # create and store the file_id.match_index indices for each sort heuristic (field order of the sort key)
+    sort_heuristic = [('length', True, (3, 4, 5, 6, 7, 8, 1, 2, 0)),
+                      ('probability', True, (4, 3, 5, 6, 7, 8, 1, 2, 0)),
+                      ('similarity', True, (5, 3, 4, 6, 7, 8, 1, 2, 0)),
+                      ('author', False, (6, 3, 4, 5, 7, 8, 1, 2, 0)),
+                      ('title', False, (7, 3, 4, 5, 6, 8, 1, 2, 0)),
+                      ('year', False, (8, 3, 4, 5, 6, 7, 1, 2, 0)),
                       ]
     if not compute_probabilities:
         sort_heuristic.pop(1)  # only process the probability measures if they're present
-    for label, inverse, key in sort_heuristic:
-        # reverse certain sort orders to proceed max to min
-        sorted_list = sorted(buff, key=key, reverse=inverse)
-        ids = [i[:6] for i in sorted_list]
-        with open(output / 'api' / 'indices' / f'match-ids-by-{label}.json', 'w', encoding='UTF-8') as out:
-            json.dump(ids, out, ensure_ascii=False)
 
-    # create the scatterplot data
-    write_scatterplots(output)
+    with TemporaryDirectory(dir=cache_location) as tmp_dir:
+        # store the minimal representations in (at most index_sort_size MB large) runs for external merge sort
+        runs = []
+        for rows in chunked_index_rows(stream_index_rows(output), index_sort_size):
+            runs.append(to_index_array(rows))
+            # spill the runs to disk if the matches do not fit into a single one
+            if len(runs) > 1:
+                for run_idx, run in enumerate(runs):
+                    if not isinstance(run, Path):
+                        runs[run_idx] = Path(tmp_dir) / f'run-{run_idx}.npy'
+                        np.save(runs[run_idx], run)
+
+        for label, inverse, key in sort_heuristic:
+            if len(runs) == 0:
+                sorted_rows = []
+            elif len(runs) == 1:
+                sorted_rows = iter_index_rows(sort_index_array(runs[0], key, inverse))
+            else:
+                # sort each run on its own, then merge the sorted runs which are read back from disk block by block
+                sorted_runs = []
+                for run_idx, run_path in enumerate(runs):
+                    sorted_run_path = Path(tmp_dir) / f'sorted-{run_idx}.npy'
+                    np.save(sorted_run_path, sort_index_array(np.load(run_path), key, inverse))
+                    sorted_runs.append(iter_index_rows(np.load(sorted_run_path, mmap_mode='r')))
+                sorted_rows = merge(*sorted_runs, key=itemgetter(*key), reverse=inverse)
+            write_json_list(output / 'api' / 'indices' / f'match-ids-by-{label}.json',
+                            (row[:6] for row in sorted_rows), page_size)
 
 
-def write_scatterplots(output):
+def stream_index_rows(output):
+    """Stream the minimal representations of all matches (see INDEX_FIELDS) to be sorted by each sort heuristic"""
+    for file_id, matches in stream_match_lists(output):
+        for match_idx, match in enumerate(matches):
+            if file_id == match.get('source_file_id'):
+                yield (match_idx,
+                       match['source_file_id'],
+                       match['target_file_id'],
+                       min(len(match['source_segment_ids']), len(match['target_segment_ids'])),
+                       match['probability'],
+                       match['similarity'],
+                       match['source_author'],
+                       match['source_title'],
+                       # only year can by empty
+                       match.get('source_year', ''),
+                       )
+
+
+def chunked_index_rows(rows, index_sort_size):
+    """Group the rows into chunks which fit into index_sort_size MB when stored as a structured array"""
+    max_bytes = index_sort_size * 2 ** 20
+    chunk, max_str_len = [], 0
+    for row in rows:
+        chunk.append(row)
+        # the fixed size fields take at most 8 bytes, the unicode fields take 4 bytes per character of the longest one
+        max_str_len = max(max_str_len, len(row[6]), len(row[7]), len(str(row[8])))
+        if len(chunk) * (6 * 8 + 3 * 4 * max_str_len) >= max_bytes:
+            yield chunk
+            chunk, max_str_len = [], 0
+    if len(chunk) > 0:
+        yield chunk
+
+
+def to_index_array(rows):
+    """Convert a list of minimal match representations into a compact NumPy structured array"""
+    columns = list(zip(*rows))
+    arrays = [np.array(columns[0], dtype=np.uint32),
+              np.array(columns[1], dtype=np.uint32),
+              np.array(columns[2], dtype=np.uint32),
+              np.array(columns[3], dtype=np.uint32),
+              np.array(columns[4]),  # -1 (int) if probabilities are not computed, float otherwise
+              np.array(columns[5], dtype=np.uint8),  # 0 <= similarity <= 100
+              np.array(columns[6], dtype=str),
+              np.array(columns[7], dtype=str),
+              np.array(columns[8]),  # int year or str if any of them is empty
+              ]
+    return np.rec.fromarrays(arrays, names=INDEX_FIELDS).view(np.ndarray)
+
+
+def sort_index_array(arr, key, inverse):
+    """Sort a structured array by the given field order (max to min if inverse)"""
+    # np.lexsort uses the last key as the primary key. As the key contains the match idx and the file ids,
+    #  every row is unique, so reversing the ascending order gives the descending order for every field
+    order = np.lexsort([arr[INDEX_FIELDS[i]] for i in reversed(key)])
+    if inverse:
+        order = order[::-1]
+    return arr[order]
+
+
+def iter_index_rows(arr, block_size=10 ** 5):
+    """Stream the rows of a (memory mapped) structured array as tuples of Python objects"""
+    for i in range(0, len(arr), block_size):
+        yield from arr[i:i + block_size].tolist()
+
+
+def write_json_list(path, rows, page_size=0):
+    """Write a stream of rows as a JSON list without holding the whole list in memory
+
+    If page_size > 0, the rows are also written into page_size long pages (path without suffix / page_idx.json)
+     with a manifest.json of the counts, so the client can lazy-load them
+    """
+    pages_dir = path.with_suffix('')
+    if page_size > 0:
+        pages_dir.mkdir(parents=True, exist_ok=True)
+    count = 0
+    with open(path, 'w', encoding='UTF-8') as out:
+        out.write('[')
+        for page_idx, page in enumerate(chunked_iterator(rows, page_size if page_size > 0 else 10 ** 5)):
+            for row in page:
+                if count > 0:
+                    out.write(', ')
+                json.dump(row, out, ensure_ascii=False)
+                count += 1
+            if page_size > 0:
+                with open(pages_dir / f'{page_idx}.json', 'w', encoding='UTF-8') as page_out:
+                    json.dump(page, page_out, ensure_ascii=False)
+        out.write(']')
+    if page_size > 0:
+        with open(pages_dir / 'manifest.json', 'w', encoding='UTF-8') as out:
+            json.dump({'count': count, 'page_size': page_size, 'pages': -(-count // page_size)}, out)
+
+
+def write_scatterplots(output, page_size):
     """Write the scatterplot JSON"""
     out_dir = output / 'api' / 'scatterplots'
+    # pre-aggregate the similarities of each level (aka data key) in a single pass over the matches
+    #  data_nest[(type, unit)][level] = [similarity sum, match count, first match of the level]
+    data_nest = defaultdict(dict)
+    for file_id, matches in stream_match_lists(output):
+        for match in matches:
+            for i in ('source', 'target'):
+                for j in ('segment_ids', 'file_id', 'author'):
+                    if j == 'segment_ids':
+                        level = f'{i}.{match[f"{i}_file_id"]}.{".".join(str(m) for m in match[f"{i}_segment_ids"])}'
+                    else:
+                        level = match[f'{i}_{j}']
+                        # ensure the level (aka data key) is a string
+                        if isinstance(level, list):
+                            level = '.'.join(str(i) for i in level)
+                    aggregate = data_nest[(i, j)].get(level)
+                    if aggregate is None:
+                        data_nest[(i, j)][level] = [match['similarity'], 1,
+                                                    {'title': match[f'{i}_title'],
+                                                     'author': match[f'{i}_author'],
+                                                     'match': match[f'{i}_match'],
+                                                     'source_year': match['source_year'],
+                                                     'target_year': match['target_year'],
+                                                     }]
+                    else:
+                        aggregate[0] += match['similarity']
+                        aggregate[1] += 1
+
     for i in ('source', 'target'):
         for j in ('segment_ids', 'file_id', 'author'):
             for k in ('sum', 'mean'):
-                data_nest = defaultdict(list)
-                for file_id, matches in stream_match_lists(output):
-                    for match in matches:
-                        if j == 'segment_ids':
-                            level = f'{i}.{match[f"{i}_file_id"]}.{".".join(str(m) for m in match[f"{i}_segment_ids"])}'
-                        else:
-                            level = match[f'{i}_{j}']
-                            # ensure the level (aka data key) is a string
-                            if isinstance(level, list):
-                                level = '.'.join(str(i) for i in level)
-                        data_nest[level].append(match)
                 # format the scatterplot data
                 scatterplot_data = []
-                for level in data_nest:
-                    sims = [o['similarity'] for o in data_nest[level]]
+                for level, (sim_sum, sim_count, o) in data_nest[(i, j)].items():
                     if k == 'sum':
-                        sim = sum(sims)
+                        sim = sim_sum
                     else:
-                        sim = sum(sims) / len(sims)
-                    o = data_nest[level][0]
+                        sim = sim_sum / sim_count
                     scatterplot_data.append({'type': i,
                                              'unit': j,
                                              'statistic': k,
                                              'key': level,
                                              'similarity': sim,
-                                             'title': o[f'{i}_title'],
-                                             'author': o[f'{i}_author'],
-                                             'match': o[f'{i}_match'],
-                                             'source_year': o['source_year'],
-                                             'target_year': o['target_year'],
+                                             **o,
                                              })
                 # write the scatterplot data
-                with open(Path(out_dir) / f'{i}-{j}-{k}.json', 'w', encoding='UTF-8') as out:
-                    json.dump(scatterplot_data, out, ensure_ascii=False)
+                write_json_list(Path(out_dir) / f'{i}-{j}-{k}.json', scatterplot_data, page_size)
 
 
 def stream_match_lists(output):
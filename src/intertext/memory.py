@@ -0,0 +1,86 @@
+import os
+import tracemalloc
+
+import numpy as np
+from vminhash import VectorizedMinHash
+
+from profiling import get_rss_mb
+from utils import get_tokens, get_words, get_windows, set_file_cache_size
+from minhash_files import get_minhashes
+
+# the estimated memory of a worker process besides the file caches and the tasks (the rest is shared with the main
+#  process after the fork)
+WORKER_BASE_MB = 32
+# the largest chunk of tasks sent to a worker at once when tuning (a worker keeps the results of a whole chunk)
+MAX_CHUNKSIZE = 64
+
+
+# Only this function is public in this file!
+def tune_memory(memory_budget, infiles, processes, chunksize, bounter_size, index_sort_size, strip_diacritics,
+                window_length, slide_length, chargram_length, n_perm, mirror, hash_family, one_permutation,
+                minhash_bits):
+    """Return the number of processes, chunk size and cache sizes that fit into memory_budget MB
+
+    The memory of the cached words and windows and the peak memory of minhashing a file are measured on the median
+     size file and scaled by the file sizes. The main process keeps the SQLite cache, the bounter and the index
+     sorting buffers, each worker keeps its file caches and runs one task at a time.
+    """
+    sizes = np.array([max(infile.stat().st_size, 1) for infile in infiles], dtype=np.float64)
+    sample = infiles[int(np.argsort(sizes)[len(sizes) // 2])]
+    hasher = VectorizedMinHash(n_perm=n_perm, mirror=mirror, hash_family=hash_family, one_permutation=one_permutation)
+    cache_per_byte, task_per_byte = measure_file_footprint(sample, hasher, strip_diacritics, window_length,
+                                                           slide_length, chargram_length, minhash_bits)
+    file_cache_mb = sizes.mean() * cache_per_byte / 2 ** 20
+    task_mb = sizes.max() * task_per_byte / 2 ** 20
+
+    # the main process
+    bounter_size = max(1, min(bounter_size, int(memory_budget * 0.1)))
+    index_sort_size = max(1, min(index_sort_size, int(memory_budget * 0.1)))
+    sqlite_cache_mb = int(min(max(memory_budget * 0.02, 2), 256))
+    main_mb = get_rss_mb() + bounter_size + index_sort_size + sqlite_cache_mb
+
+    # the workers need at least the files of a file pair in their caches
+    workers_mb = memory_budget - main_mb
+    min_worker_mb = WORKER_BASE_MB + task_mb + 2 * file_cache_mb
+    n_processes = int(min(max(workers_mb // min_worker_mb, 1), processes or os.cpu_count()))
+    spare_mb = workers_mb / n_processes - WORKER_BASE_MB - task_mb
+    file_cache_size = int(min(max(spare_mb // max(file_cache_mb, 1e-3), 2), max(len(infiles), 2)))
+    if chunksize is None:
+        chunksize = int(min(max(spare_mb // max(task_mb, 1), 1), MAX_CHUNKSIZE))
+    if workers_mb < min_worker_mb:
+        print(f' * warning: --memory_budget {memory_budget} MB is below the estimated '
+              f'{main_mb + min_worker_mb:.0f} MB needed with one worker process')
+
+    return {'processes': n_processes,
+            'chunksize': chunksize,
+            'file_cache_size': file_cache_size,
+            'sqlite_cache_mb': sqlite_cache_mb,
+            'bounter_size': bounter_size,
+            'index_sort_size': index_sort_size,
+            # the estimates behind the settings
+            'main_mb': round(main_mb, 1),
+            'file_cache_mb': round(file_cache_mb, 3),
+            'task_mb': round(task_mb, 1),
+            }
+
+
+def measure_file_footprint(path, hasher, strip_diacritics, window_length, slide_length, chargram_length,
+                           minhash_bits):
+    """Return the memory of the cached words and windows and the peak memory of minhashing per byte of a file"""
+    size = max(path.stat().st_size, 1)
+    set_file_cache_size(8)
+    tracemalloc.start()
+    try:
+        get_tokens(path)
+        get_words(path, strip_diacritics, False)
+        get_words(path, strip_diacritics, True)
+        get_windows(path, strip_diacritics, window_length, slide_length)
+        cached, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        get_minhashes(path, hasher, strip_diacritics, window_length, slide_length, chargram_length, minhash_bits)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        # drop the measured files from the caches
+        set_file_cache_size(8)
+    return cached / size, max(peak - cached, 0) / size
@@ -1,48 +1,121 @@
 import numpy as np
-from vminhash import VectorizedMinHash, byte_hashes
+from numpy.lib.stride_tricks import sliding_window_view
+from vminhash import VectorizedMinHash, byte_range_hashes
 
-from utils import get_windows, ngrams, parallel_map
+from utils import get_window_bytes, parallel_map, share
 
 
 # Only this function is public in this file!
 def get_all_hashbands(infiles, cache_location, strip_diacritics, window_length, slide_length, chargram_length,
-                      hashband_length, hashband_step, cache_db):
-    """Generate and save hashbands for each infile"""
-    hasher = VectorizedMinHash(n_perm=256)
-    buff = [(idx, file_path, cache_location / 'minhashes' / (str(file_path).replace('/', '___') + '.npy'))
+                      hashband_length, hashband_step, n_perm, mirror, hash_family, one_permutation, minhash_bits,
+                      only_id, cache_db):
+    """Generate and save hashbands for each infile (only the ones shared with the only_id file if specified)
+
+    The files hashed by a previous (interrupted) run with the same settings are skipped.
+    """
+    hasher = VectorizedMinHash(n_perm=n_perm, mirror=mirror, hash_family=hash_family, one_permutation=one_permutation)
+    # the cached minhashes are only valid for the same windows and hasher settings
+    settings = f'{window_length}-{slide_length}-{chargram_length}-{int(strip_diacritics)}-{hash_family}-{n_perm}-' \
+               f'{int(mirror)}-{int(one_permutation)}-{minhash_bits}'
+    buff = [(idx, file_path,
+             cache_location / 'minhashes' / (str(file_path).replace('/', '___') + f'.{settings}.npy'))
             for idx, file_path in enumerate(infiles)]
-    parallel_map(get_file_hashbands, buff, hasher=hasher, strip_diacritics=strip_diacritics,
-                 window_length=window_length, slide_length=slide_length, chargram_length=chargram_length,
-                 hashband_length=hashband_length, hashband_step=hashband_step, cache_db=cache_db)
+    hashband_kwargs = {'hasher': hasher, 'strip_diacritics': strip_diacritics, 'window_length': window_length,
+                       'slide_length': slide_length, 'chargram_length': chargram_length,
+                       'hashband_length': hashband_length, 'hashband_step': hashband_step,
+                       'minhash_bits': minhash_bits}
+    done = {row[0] for row in cache_db.stream_done_tasks('minhash')}
+    only_hashbands = None
+    if only_id is not None:
+        # hash the only file first, then the other files only store the hashbands they share with it
+        #  (the rest could only give candidates without the only file)
+        only_hashbands, window_ids = get_file_window_hashbands(buff[only_id], **hashband_kwargs)
+        if str(only_id) not in done:
+            write_file_hashbands(only_id, only_hashbands, window_ids, cache_db)
+        only_hashbands = np.unique(only_hashbands)
+        # sent to each worker once instead of with each chunk of tasks
+        share(only_hashbands=only_hashbands)
+        buff.pop(only_id)
+    buff = [args for args in buff if str(args[0]) not in done]
+    parallel_map(get_file_hashbands, buff, only_hashbands=only_hashbands, cache_db=cache_db, **hashband_kwargs)
 
 
 def get_file_hashbands(args, hasher, strip_diacritics, window_length, slide_length, chargram_length, hashband_length,
-                       hashband_step, cache_db):
-    """Minhash a file and save [[hashband, file_idx, window_idx]]"""
+                       hashband_step, minhash_bits, only_hashbands, cache_db):
+    """Minhash a file and save [[hashband, file_idx, window_idx]] (only the ones in only_hashbands if specified)"""
+    hashbands, window_ids = get_file_window_hashbands(args, hasher, strip_diacritics, window_length, slide_length,
+                                                      chargram_length, hashband_length, hashband_step, minhash_bits)
+    if only_hashbands is not None:
+        shared = np.isin(hashbands, only_hashbands)
+        hashbands, window_ids = hashbands[shared], window_ids[shared]
+    write_file_hashbands(args[0], hashbands, window_ids, cache_db)
+
+
+def get_file_window_hashbands(args, hasher, strip_diacritics, window_length, slide_length, chargram_length,
+                              hashband_length, hashband_step, minhash_bits):
+    """Minhash a file and return the arrays of its (distinct per window) hashbands and their window ids"""
     file_idx, file_path, minhash_path = args
     minhashes = get_file_minhashes(file_path, minhash_path, hasher, strip_diacritics, window_length, slide_length,
-                                   chargram_length)
-    # get the hashbands for this minhash
-    hashbands = set()
-    for window_idx, minhash in enumerate(minhashes):
-        for hdx, h in enumerate(ngrams(minhash, hashband_length)):
-            if hdx % hashband_step == 0:
-                hashbands.add(('.'.join(str(i) for i in h), file_idx, window_idx))
-    if len(hashbands) > 0:
-        cache_db.write_hashbands(hashbands)
-
-
-def get_file_minhashes(file_path, minhash_path, hasher, strip_diacritics, window_length, slide_length, chargram_length):
-    """Return the minhash array for a file"""
+                                   chargram_length, minhash_bits)
+    return get_window_hashbands(minhashes, hashband_length, hashband_step)
+
+
+def get_window_hashbands(minhashes, hashband_length, hashband_step):
+    """Return the arrays of the (distinct per window) hashbands of the minhashes and their window ids"""
+    # get the hashbands for all windows at once and drop the repeated hashbands of each window
+    hashbands = np.sort(get_hashbands(minhashes, hashband_length, hashband_step), axis=1)
+    keep = np.ones(hashbands.shape, dtype=bool)
+    keep[:, 1:] = hashbands[:, 1:] != hashbands[:, :-1]
+    window_ids = np.broadcast_to(np.arange(hashbands.shape[0])[:, None], hashbands.shape)
+    # SQLite INTEGER is signed 64 bit
+    return hashbands[keep].view(np.int64), window_ids[keep]
+
+
+def write_file_hashbands(file_idx, hashbands, window_ids, cache_db):
+    """Save [[hashband, file_idx, window_idx]] of a file and mark the file done"""
+    cache_db.write_hashbands(list(zip(hashbands.tolist(), [file_idx] * len(hashbands), window_ids.tolist())),
+                             done=[('minhash', str(file_idx))])
+
+
+def get_hashbands(minhashes, hashband_length, hashband_step):
+    """Hash every hashband_step-th run of hashband_length minhash values of each window into an uint64
+
+    Returns a (n_windows, n_hashbands) matrix. The hash is the 64 bit FNV-1a of the minhash values
+     (instead of bytes) with the splitmix64 finalizer, so the collisions of distinct hashbands are negligible.
+    """
+    # (n_windows, n_hashbands, hashband_length) view without copying
+    bands = sliding_window_view(minhashes, hashband_length, axis=1)[:, ::hashband_step]
+    hashbands = np.full(bands.shape[:2], 0xcbf29ce484222325, dtype=np.uint64)
+    for i in range(hashband_length):
+        hashbands ^= bands[:, :, i].astype(np.uint64)
+        hashbands *= np.uint64(0x100000001b3)
+    hashbands ^= hashbands >> np.uint64(30)
+    hashbands *= np.uint64(0xbf58476d1ce4e5b9)
+    hashbands ^= hashbands >> np.uint64(27)
+    hashbands *= np.uint64(0x94d049bb133111eb)
+    hashbands ^= hashbands >> np.uint64(31)
+    return hashbands
+
+
+def get_file_minhashes(file_path, minhash_path, hasher, strip_diacritics, window_length, slide_length, chargram_length,
+                       minhash_bits):
+    """Return the minhash array for a file (only the lowest minhash_bits bits of each value are kept)"""
     if minhash_path.exists():
         print(' * loading', file_path, 'minhashes from cache')
         return np.load(minhash_path)
-    # run minhash algorithm on file
-    buff = []
-    for window_idx, window in enumerate(get_windows(file_path, strip_diacritics, window_length, slide_length)):
-        char_hashes = byte_hashes(window.lower().encode('UTF-8'), n=chargram_length)
-        fingerprint = hasher.fingerprint(char_hashes)
-        buff.append(fingerprint)
-    minhashes = np.array(buff)
+    minhashes = get_minhashes(file_path, hasher, strip_diacritics, window_length, slide_length, chargram_length,
+                              minhash_bits)
     np.save(minhash_path, minhashes)
     return minhashes
+
+
+def get_minhashes(file_path, hasher, strip_diacritics, window_length, slide_length, chargram_length, minhash_bits):
+    """Run the minhash algorithm on all windows of a file at once"""
+    buff = byte_range_hashes(*get_window_bytes(file_path, strip_diacritics, window_length, slide_length),
+                             n=chargram_length)
+    return reduce_precision(hasher.fingerprints(buff), minhash_bits)
+
+
+def reduce_precision(minhashes, minhash_bits):
+    """Keep the lowest minhash_bits bits of the minhashes (b-bit minwise hashing) to save space"""
+    return minhashes.astype({8: np.uint8, 16: np.uint16, 32: np.uint32}[minhash_bits])
@@ -0,0 +1,285 @@
+import os
+import json
+import time
+import cProfile
+import pstats
+import random
+from functools import wraps
+from types import GeneratorType
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+# the SQLite metrics of this process (the main process or a worker) by SQLCache method: [calls, seconds, rows]
+_sql_metrics = defaultdict(lambda: [0, 0.0, 0])
+# the report of the run (only used in the main process)
+_report = {'stages': []}
+_current_stage = None
+# the number of task wall times kept per stage for the median (a uniform sample of the tasks of larger stages)
+_TASK_SAMPLE_SIZE = 1024
+_profile_dir = None
+_verbose = False
+
+
+def start_report(profile_dir=None, verbose=False):
+    """Reset the metrics report, save the cProfile stats of each stage into profile_dir if specified"""
+    global _report, _current_stage, _profile_dir, _verbose
+    _report = {'cpu_count': os.cpu_count(), 'started': time.time(), 'peak_rss_mb': 0.0,
+               # the peak RSS of the stages and tasks are their own if the peak can be reset, otherwise they are the
+               #  running peaks of their processes
+               'peak_rss_per_stage': reset_peak_rss(), 'tuning': [], 'stages': []}
+    _current_stage = None
+    _profile_dir = profile_dir
+    _verbose = verbose
+    _sql_metrics.clear()
+    if profile_dir is not None:
+        profile_dir.mkdir(parents=True, exist_ok=True)
+
+
+def write_report(path):
+    """Write the metrics report of the run as JSON"""
+    _report['wall_seconds'] = time.time() - _report.get('started', time.time())
+    update_run_peak_rss()
+    with open(path, 'w', encoding='UTF-8') as out:
+        json.dump(_report, out, indent=2)
+
+
+def record_tuning(settings):
+    """Log the tuned settings of the run (e.g. to fit the memory budget) and add them to the report"""
+    print(' * tuned settings:', ', '.join(f'{key}={value}' for key, value in settings.items()))
+    _report.setdefault('tuning', []).append({'stage': _current_stage['name'] if _current_stage else None,
+                                             **settings})
+
+
+def profiling_enabled():
+    """Return True if the stages (and their tasks) should be profiled with cProfile"""
+    return _profile_dir is not None
+
+
+@contextmanager
+def stage(name):
+    """Measure the wall and CPU time, peak RSS, tasks and SQLite rows of a pipeline stage"""
+    global _current_stage
+    _current_stage = {'name': name, 'tasks': new_task_summary(), 'sql': defaultdict(lambda: [0, 0.0, 0]),
+                      'stats': None, 'peak_rss_mb': 0.0}
+    sql_before = {method: list(values) for method, values in _sql_metrics.items()}
+    profiler = cProfile.Profile() if profiling_enabled() else None
+    update_run_peak_rss()
+    reset_peak_rss()
+    times_before, wall_before = os.times(), time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        wall, times_after = time.perf_counter() - wall_before, os.times()
+        # the SQLite metrics of the main process and of the tasks run in the worker processes
+        for method, (calls, seconds, rows) in _sql_metrics.items():
+            calls_before, seconds_before, rows_before = sql_before.get(method, (0, 0.0, 0))
+            _add_sql_metrics(_current_stage['sql'], method, (calls - calls_before, seconds - seconds_before,
+                                                            rows - rows_before))
+        sql = {method: {'calls': calls, 'seconds': seconds, 'rows': rows}
+               for method, (calls, seconds, rows) in sorted(_current_stage['sql'].items()) if calls > 0}
+        stage_report = {'name': name,
+                        'wall_seconds': wall,
+                        # the CPU time of the main process and of the tasks run by other processes (the pool
+                        #  workers are only reaped after the last stage, so the children times miss them)
+                        'cpu_seconds': sum(times_after[:2]) - sum(times_before[:2]) +
+                        _current_stage['tasks']['worker_cpu_seconds'],
+                        # of the main process (the peaks of the workers are in the tasks)
+                        'peak_rss_mb': max(_current_stage['peak_rss_mb'], get_peak_rss_mb()),
+                        'rows_in': sum(values['rows'] for method, values in sql.items()
+                                       if method.startswith('stream_')),
+                        'rows_out': sum(values['rows'] for method, values in sql.items()
+                                        if method.startswith('write_')),
+                        'sql': sql,
+                        'tasks': summarize_tasks(_current_stage['tasks']),
+                        }
+        if profiler is not None:
+            stats = pstats.Stats(profiler)
+            if _current_stage['stats'] is not None:
+                stats.add(_current_stage['stats'])
+            stats.dump_stats(_profile_dir / f'{name}.prof')
+            stage_report['profile'] = str(_profile_dir / f'{name}.prof')
+        _report['stages'].append(stage_report)
+        _current_stage = None
+        if _verbose:
+            print(f' * {name} took {wall:.2f} s wall, {stage_report["cpu_seconds"]:.2f} s CPU, '
+                  f'{stage_report["peak_rss_mb"]:.0f} MB peak RSS')
+
+
+def run_task(args, fun, profile):
+    """Run a parallel_map task in a worker and return (result, task metrics)"""
+    _sql_metrics.clear()
+    # the peak RSS of the task, not of all tasks run by the worker so far (the peak of the stage so far is kept if
+    #  the task is run by the main process, e.g. the coordinator of a sharded run)
+    if _current_stage is not None:
+        _current_stage['peak_rss_mb'] = max(_current_stage['peak_rss_mb'], get_peak_rss_mb())
+    reset_peak_rss()
+    profiler = cProfile.Profile() if profile else None
+    wall_before, cpu_before = time.perf_counter(), time.process_time()
+    if profiler is not None:
+        profiler.enable()
+    result = fun(args)
+    if profiler is not None:
+        profiler.disable()
+        profiler.create_stats()
+    metrics = {'pid': os.getpid(),
+               'wall_seconds': time.perf_counter() - wall_before,
+               'cpu_seconds': time.process_time() - cpu_before,
+               'peak_rss_mb': get_peak_rss_mb(),
+               'sql': dict(_sql_metrics),
+               'profile': profiler.stats if profiler is not None else None,
+               }
+    return result, metrics
+
+
+def record_tasks(task_results):
+    """Add the metrics of the finished parallel_map tasks to the current stage and return their results"""
+    results = []
+    for result, metrics in task_results:
+        results.append(result)
+        if _current_stage is not None:
+            for method, values in metrics['sql'].items():
+                _add_sql_metrics(_current_stage['sql'], method, values)
+            if metrics['profile'] is not None:
+                # merge the profiles as they arrive, so only one set of stats is kept per stage
+                if _current_stage['stats'] is None:
+                    _current_stage['stats'] = pstats.Stats(_StatsHolder(metrics['profile']))
+                else:
+                    _current_stage['stats'].add(_StatsHolder(metrics['profile']))
+            add_task(_current_stage['tasks'], metrics)
+    return results
+
+
+def new_task_summary():
+    """Return the running aggregates of the task metrics of a stage"""
+    return {'count': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'worker_cpu_seconds': 0.0, 'max_wall_seconds': 0.0,
+            'wall_sample': [],
+            'workers': defaultdict(lambda: {'tasks': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'peak_rss_mb': 0.0})}
+
+
+def add_task(tasks, metrics):
+    """Add the metrics of a task to the running aggregates of a stage"""
+    tasks['count'] += 1
+    tasks['wall_seconds'] += metrics['wall_seconds']
+    tasks['cpu_seconds'] += metrics['cpu_seconds']
+    # the tasks run by the main process itself (e.g. the coordinator of a sharded run) are in its own CPU time
+    if metrics['pid'] != os.getpid():
+        tasks['worker_cpu_seconds'] += metrics['cpu_seconds']
+    tasks['max_wall_seconds'] = max(tasks['max_wall_seconds'], metrics['wall_seconds'])
+    # reservoir sampling of the wall times
+    if len(tasks['wall_sample']) < _TASK_SAMPLE_SIZE:
+        tasks['wall_sample'].append(metrics['wall_seconds'])
+    else:
+        sample_idx = random.randrange(tasks['count'])
+        if sample_idx < _TASK_SAMPLE_SIZE:
+            tasks['wall_sample'][sample_idx] = metrics['wall_seconds']
+    worker = tasks['workers'][metrics['pid']]
+    worker['tasks'] += 1
+    worker['wall_seconds'] += metrics['wall_seconds']
+    worker['cpu_seconds'] += metrics['cpu_seconds']
+    worker['peak_rss_mb'] = max(worker['peak_rss_mb'], metrics['peak_rss_mb'])
+
+
+def summarize_tasks(tasks):
+    """Return the task metrics of a stage with the totals by worker process"""
+    if tasks['count'] == 0:
+        return {'count': 0}
+    walls = sorted(tasks['wall_sample'])
+    return {'count': tasks['count'],
+            'wall_seconds': tasks['wall_seconds'],
+            'cpu_seconds': tasks['cpu_seconds'],
+            # exact up to _TASK_SAMPLE_SIZE tasks
+            'median_wall_seconds': walls[len(walls) // 2],
+            'max_wall_seconds': tasks['max_wall_seconds'],
+            'workers': {str(pid): worker for pid, worker in tasks['workers'].items()},
+            }
+
+
+def sql_timer(method):
+    """Record the calls, time and rows of an SQLCache method (rows are written or streamed rows)"""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        result = method(self, *args, **kwargs)
+        if isinstance(result, GeneratorType):
+            return _timed_generator(method.__name__, result, time.perf_counter() - start)
+        rows = len(args[0]) if len(args) > 0 and hasattr(args[0], '__len__') else 0
+        _add_sql_metrics(_sql_metrics, method.__name__, (1, time.perf_counter() - start, rows))
+        return result
+    return wrapper
+
+
+def _timed_generator(name, generator, seconds):
+    """Stream the rows of a reader while only timing the time spent in the reader (not in the consumer)"""
+    rows = 0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                row = next(generator)
+            except StopIteration:
+                break
+            finally:
+                seconds += time.perf_counter() - start
+            rows += 1
+            yield row
+    finally:
+        _add_sql_metrics(_sql_metrics, name, (1, seconds, rows))
+
+
+def _add_sql_metrics(metrics, method, values):
+    calls, seconds, rows = values
+    metrics[method][0] += calls
+    metrics[method][1] += seconds
+    metrics[method][2] += rows
+
+
+def update_run_peak_rss():
+    """Add the peak resident set size of the main process so far to the peak of the run"""
+    _report['peak_rss_mb'] = max(_report.get('peak_rss_mb', 0.0), get_peak_rss_mb())
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size of this process to its current size, return False if not possible"""
+    try:
+        # resets the peak (VmHWM, also reported by getrusage) on Linux
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def get_peak_rss_mb():
+    """Return the peak resident set size of this process (since the last reset) in MB (0 if unknown)"""
+    if resource is None:
+        return 0.0
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def get_rss_mb():
+    """Return the current resident set size of this process in MB (the peak if unknown)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return get_peak_rss_mb()
+
+
+class _StatsHolder:
+    """Wrap the stats of a cProfile.Profile from a worker, so they can be added to pstats.Stats"""
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
@@ -0,0 +1,150 @@
+import sys
+import json
+import argparse
+from pathlib import Path
+
+import numpy as np
+from numpy.lib.format import open_memmap
+from vminhash import VectorizedMinHash
+
+from config import non_empty_glob
+from utils import chunked_iterator, get_windows
+from minhash_files import get_minhashes, get_window_hashbands
+from validate_matches import get_window_similarity
+from format_matches import get_clusters, format_matches
+
+# the settings which must be the same for the index and the query texts
+INDEX_SETTINGS = ('strip_diacritics', 'window_length', 'slide_length', 'chargram_length', 'hashband_length',
+                  'hashband_step', 'n_perm', 'mirror', 'hash_family', 'one_permutation', 'minhash_bits',
+                  'xml_page_tag', 'xml_page_attr', 'min_sim')
+# the number of postings written at once when building the index
+INDEX_BLOCK_SIZE = 10 ** 6
+
+
+def build_query_index(index_dir, infiles, metadata, settings, cache_db):
+    """Save the hashbands of the corpus as a memory mappable hashband -> [(file_id, window_id)] postings index"""
+    print(' * building query index')
+    index_dir.mkdir(parents=True, exist_ok=True)
+    n_postings = cache_db.count_hashbands()
+    # the postings of each distinct hashband are consecutive (in hashband order), they are written block by block
+    postings = open_memmap(index_dir / 'postings.npy', mode='w+', dtype=np.uint32, shape=(n_postings, 2))
+    keys, counts = [], []
+    offset = 0
+    for rows in chunked_iterator(cache_db.stream_all_hashbands(), INDEX_BLOCK_SIZE):
+        hashbands, file_ids, window_ids = np.array(rows, dtype=np.int64).T
+        postings[offset:offset + len(rows), 0] = file_ids
+        postings[offset:offset + len(rows), 1] = window_ids
+        offset += len(rows)
+        block_keys, block_counts = np.unique(hashbands, return_counts=True)
+        # the postings of a hashband may continue from the previous blocks (even over whole blocks)
+        if len(keys) > 0 and keys[-1][-1] == block_keys[0]:
+            counts[-1][-1] += block_counts[0]
+            block_keys, block_counts = block_keys[1:], block_counts[1:]
+        # only non-empty blocks are kept, so keys[-1][-1] is always the last hashband
+        if len(block_keys) > 0:
+            keys.append(block_keys)
+            counts.append(block_counts)
+    postings.flush()
+    keys = np.concatenate(keys + [np.array([], dtype=np.int64)])
+    np.save(index_dir / 'hashbands.npy', keys)
+    np.save(index_dir / 'offsets.npy', np.concatenate(([0], np.cumsum(np.concatenate(counts + [[]]))))
+            .astype(np.int64))
+    with open(index_dir / 'index.json', 'w', encoding='UTF-8') as out:
+        json.dump({'infiles': [str(infile.resolve()) for infile in infiles],
+                   'metadata': metadata,
+                   **{setting: settings[setting] for setting in INDEX_SETTINGS},
+                   }, out, ensure_ascii=False)
+
+
+class QueryIndex:
+    """Match new texts against an indexed corpus (the index is memory mapped, so it is loaded lazily)"""
+    def __init__(self, index_dir):
+        with open(index_dir / 'index.json', encoding='UTF-8') as f:
+            self.settings = json.load(f)
+        self.infiles = [Path(infile) for infile in self.settings['infiles']]
+        self._hashbands = np.load(index_dir / 'hashbands.npy', mmap_mode='r')
+        self._offsets = np.load(index_dir / 'offsets.npy', mmap_mode='r')
+        self._postings = np.load(index_dir / 'postings.npy', mmap_mode='r')
+        self._hasher = VectorizedMinHash(n_perm=self.settings['n_perm'], mirror=self.settings['mirror'],
+                                         hash_family=self.settings['hash_family'],
+                                         one_permutation=self.settings['one_permutation'])
+        self._file_windows = {}
+
+    def query(self, query_file, min_sim=None, query_metadata=None):
+        """Return the matches of a text file in the corpus in the format of the output matches"""
+        s = self.settings
+        min_sim = min_sim if min_sim is not None else s['min_sim']
+        query_file = Path(query_file)
+        minhashes = get_minhashes(query_file, self._hasher, s['strip_diacritics'], s['window_length'],
+                                  s['slide_length'], s['chargram_length'], s['minhash_bits'])
+        hashbands, query_window_ids = get_window_hashbands(minhashes, s['hashband_length'], s['hashband_step'])
+        candidates = self.get_candidates(hashbands, query_window_ids)
+        # the query text gets the next file id after the corpus, so it is file b of each file pair
+        query_file_id = len(self.infiles)
+        metadata = {query_file.name: {'author': 'Unknown', 'title': query_file.name}, **s['metadata']}
+        if query_metadata is not None:
+            metadata[query_file.name] = {**metadata[query_file.name], **query_metadata}
+        query_windows = get_windows(query_file, s['strip_diacritics'], s['window_length'], s['slide_length'])
+        matches = []
+        for file_id in np.unique(candidates[:, 0]).tolist():
+            if self.infiles[file_id].resolve() == query_file.resolve():
+                continue  # the query text is in the corpus
+            file_windows = self.get_file_windows(file_id)
+            pair_matches = []
+            for _, window_id, query_window_id in candidates[candidates[:, 0] == file_id].tolist():
+                sim = get_window_similarity(file_windows[window_id], query_windows[query_window_id], min_sim,
+                                            s['window_length'])
+                if sim is not None:
+                    pair_matches.append((window_id, query_window_id, sim))
+            if len(pair_matches) > 0:
+                matches.extend(format_matches(file_id, query_file_id, len(matches),
+                                              get_clusters(pair_matches, min_sim), None, metadata,
+                                              self.infiles[file_id], query_file, s['strip_diacritics'],
+                                              s['xml_page_tag'], s['xml_page_attr'], s['window_length'],
+                                              s['slide_length']))
+        return matches
+
+    def get_file_windows(self, file_id):
+        """Return the windows of a corpus file (kept in memory once loaded)"""
+        if file_id not in self._file_windows:
+            s = self.settings
+            self._file_windows[file_id] = get_windows(self.infiles[file_id], s['strip_diacritics'],
+                                                      s['window_length'], s['slide_length'])
+        return self._file_windows[file_id]
+
+    def get_candidates(self, hashbands, query_window_ids):
+        """Return the distinct [file_id, window_id, query_window_id] rows of the postings of the query hashbands"""
+        positions = np.searchsorted(self._hashbands, hashbands)
+        found = positions < len(self._hashbands)
+        found[found] = self._hashbands[positions[found]] == hashbands[found]
+        positions, query_window_ids = positions[found], query_window_ids[found]
+        # the positions of all postings of the found hashbands
+        starts, ends = self._offsets[positions], self._offsets[positions + 1]
+        lengths = ends - starts
+        posting_ids = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        candidates = np.column_stack((self._postings[posting_ids], np.repeat(query_window_ids, lengths)))
+        return np.unique(candidates.astype(np.int64), axis=0).reshape(-1, 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Match texts against a corpus indexed by intertext --query_index',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--index', type=Path, required=True, help='the query index directory of the corpus')
+    parser.add_argument('--infiles', '-i', type=non_empty_glob, required=True,
+                        help='path to a glob of text files to match against the corpus')
+    parser.add_argument('--min_sim', '-s', type=int, default=None,
+                        help='the minimum similarity of matches to retain (default: the one of the index)')
+    parser.add_argument('--output', '-o', type=Path, default=None,
+                        help='the JSON file of the matches of each infile (default: stdout)')
+    args = parser.parse_args()
+    index = QueryIndex(args.index)
+    matches = {str(infile): index.query(infile, args.min_sim) for infile in args.infiles}
+    if args.output is None:
+        json.dump(matches, sys.stdout, ensure_ascii=False, indent=1)
+    else:
+        with open(args.output, 'w', encoding='UTF-8') as out:
+            json.dump(matches, out, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+import json
+import queue
+import argparse
+import threading
+from pathlib import Path
+from hashlib import sha1
+from tempfile import TemporaryDirectory
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from query_index import QueryIndex
+
+
+class MatchService:
+    """Answer passage queries against a query index in batches with an LRU cache of the recent queries"""
+    def __init__(self, index_dir, cache_size, batch_size, batch_wait):
+        self.index = QueryIndex(index_dir)
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._cache_lock = threading.Lock()
+        self._batch_size = batch_size
+        self._batch_wait = batch_wait
+        self._queue = queue.Queue()
+        self._passage_dir = TemporaryDirectory()
+        # keep the windows of the corpus in memory
+        for file_id in range(len(self.index.infiles)):
+            self.index.get_file_windows(file_id)
+        threading.Thread(target=self._run_batches, daemon=True).start()
+
+    def query(self, passages, min_sim=None):
+        """Return the matches of each passage {text, [author], [title]} (blocks until they are answered)"""
+        futures = []
+        for passage in passages:
+            key = (passage['text'], passage.get('author'), passage.get('title'), min_sim)
+            with self._cache_lock:
+                matches = self._cache.get(key)
+                if matches is not None:
+                    self._cache.move_to_end(key)
+            future = Future()
+            if matches is not None:
+                future.set_result(matches)
+            else:
+                self._queue.put((key, future))
+            futures.append(future)
+        return [future.result() for future in futures]
+
+    def _run_batches(self):
+        """Answer the queued passages in batches (the identical passages of a batch are only queried once)"""
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < self._batch_size:
+                    batch.append(self._queue.get(timeout=self._batch_wait))
+            except queue.Empty:
+                pass
+            futures = OrderedDict()
+            for key, future in batch:
+                futures.setdefault(key, []).append(future)
+            for key, key_futures in futures.items():
+                try:
+                    matches = self._query_passage(*key)
+                except Exception as e:
+                    for future in key_futures:
+                        future.set_exception(e)
+                    continue
+                with self._cache_lock:
+                    self._cache[key] = matches
+                    if len(self._cache) > self._cache_size:
+                        self._cache.popitem(last=False)
+                for future in key_futures:
+                    future.set_result(matches)
+
+    def _query_passage(self, text, author, title, min_sim):
+        """Match a passage against the corpus (the passage is a file named by its hash for the pipeline helpers)"""
+        path = Path(self._passage_dir.name) / f'{sha1(text.encode("UTF-8")).hexdigest()}.txt'
+        path.write_text(text, encoding='UTF-8')
+        try:
+            return self.index.query(path, min_sim, {'author': author or 'Unknown', 'title': title or 'Query'})
+        finally:
+            path.unlink()
+
+
+class MatchRequestHandler(BaseHTTPRequestHandler):
+    """POST /query {"passages": [{"text": ..., "author": ..., "title": ...}], "min_sim": ...} -> {"matches": [...]}"""
+    service = None
+
+    def do_GET(self):
+        if self.path != '/health':
+            self.send_json(404, {'error': 'not found'})
+            return
+        self.send_json(200, {'files': len(self.service.index.infiles),
+                             **{setting: self.service.index.settings[setting]
+                                for setting in ('window_length', 'slide_length', 'min_sim')}})
+
+    def do_POST(self):
+        if self.path != '/query':
+            self.send_json(404, {'error': 'not found'})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            passages = request['passages'] if 'passages' in request else [request]
+            if not all(isinstance(passage.get('text'), str) for passage in passages):
+                raise ValueError('each passage needs a text')
+            min_sim = request.get('min_sim')
+            if min_sim is not None and (isinstance(min_sim, bool) or not isinstance(min_sim, (int, float)) or
+                                        not 0 <= min_sim <= 100):
+                raise ValueError('min_sim must be a number between 0 and 100')
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        try:
+            matches = self.service.query(passages, min_sim)
+        except Exception as e:
+            self.log_error('query failed: %r', e)
+            self.send_json(500, {'error': f'query failed: {e}'})
+            return
+        self.send_json(200, {'matches': matches})
+
+    def send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode('UTF-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the matches of passages against a corpus indexed by '
+                                                 'intertext --query_index',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--index', type=Path, required=True, help='the query index directory of the corpus')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='the host to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='the port to listen on')
+    parser.add_argument('--cache_size', type=int, default=1024, help='the number of recent queries to cache')
+    parser.add_argument('--batch_size', type=int, default=32, help='the maximum number of passages per batch')
+    parser.add_argument('--batch_wait', type=float, default=0.01,
+                        help='the seconds to wait for more passages before answering a batch')
+    args = parser.parse_args()
+    MatchRequestHandler.service = MatchService(args.index, args.cache_size, args.batch_size, args.batch_wait)
+    server = ThreadingHTTPServer((args.host, args.port), MatchRequestHandler)
+    print(f' * serving matches on http://{args.host}:{args.port}/query')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+"""Sharded execution of the parallel_map tasks by worker processes on any number of nodes
+
+The coordinator (the intertext run with --shard_dir) writes the tasks of each stage as task files into the shared
+ shard directory, the workers (python sharding.py --shard_dir ... on each node) claim them by atomically renaming
+ them into the claimed directory and write their results into the results directory. The coordinator claims tasks
+ as well, and merges the results: the cache db is not shared, so the db rows read by a task are sent with it and
+ the db writes of a task are recorded and replayed by the coordinator. The kwargs of a stage (e.g. the word
+ counts) are written once into the kwargs directory and loaded once by each worker. The infiles, the output and the
+ cache location must be on a shared filesystem with the same paths on all nodes. The coordinator writes the settings
+ of its run (a run id, which is part of the task names, and the stale seconds) into the settings file of the shard
+ directory, so the workers never mix up the tasks of different runs and touch their claimed tasks often enough.
+"""
+import os
+import json
+import sys
+import time
+import atexit
+import pickle
+import socket
+import argparse
+import threading
+import traceback
+from pathlib import Path
+from uuid import uuid4
+from multiprocessing import Process
+
+from profiling import run_task
+
+
+# the settings of the coordinator (only used in the coordinator process)
+_shard_dir = None
+_run_id = None
+_task_size = 16
+_stale_seconds = 600
+_n_stages = 0
+# the kwargs file of the current stage and its kwargs (in any process running tasks, each loads it once)
+_stage_kwargs = (None, None)
+
+
+def start_sharding(shard_dir, task_size, stale_seconds):
+    """Run the parallel_map tasks through task files in shard_dir (the tasks of a previous run are dropped)"""
+    global _shard_dir, _run_id, _task_size, _stale_seconds, _n_stages
+    _shard_dir, _run_id, _task_size, _stale_seconds, _n_stages = shard_dir, uuid4().hex, task_size, stale_seconds, 0
+    for directory in ('tasks', 'claimed', 'results', 'kwargs'):
+        (shard_dir / directory).mkdir(parents=True, exist_ok=True)
+        for path in (shard_dir / directory).iterdir():
+            path.unlink()
+    (shard_dir / 'finished').unlink(missing_ok=True)
+    write_atomically(shard_dir / 'settings.json', {'run_id': _run_id, 'stale_seconds': stale_seconds}, json_format=True)
+    atexit.register(stop_sharding)
+
+
+def stop_sharding():
+    """Let the workers exit"""
+    global _shard_dir
+    if _shard_dir is not None:
+        (_shard_dir / 'finished').touch()
+        _shard_dir = None
+
+
+def sharding_enabled():
+    """Return True if the parallel_map tasks should be run through task files"""
+    return _shard_dir is not None
+
+
+def shard_reads(reads):
+    """Declare the cache db reads [(method, args)] of each task of a function, so they are sent with the tasks"""
+    def decorator(fun):
+        fun.shard_reads = reads
+        return fun
+    return decorator
+
+
+def sharded_map(fun, buff, kwargs, profile):
+    """Run fun(args, **kwargs) for each args of buff through task files and return [(result, task metrics)]"""
+    global _n_stages
+    _n_stages += 1
+    cache_db = kwargs.get('cache_db')
+    reads = getattr(fun, 'shard_reads', None)
+    # the kwargs are the same for all tasks of the stage, so they are only written once
+    kwargs_name = f'{_run_id}-{_n_stages:03d}-{fun.__name__}.pkl'
+    write_atomically(_shard_dir / 'kwargs' / kwargs_name,
+                     {key: value for key, value in kwargs.items() if key != 'cache_db'})
+    # write the task files (each with up to task_size args)
+    pending = {}
+    buff = list(buff)
+    for task_idx, start in enumerate(range(0, len(buff), _task_size)):
+        items = buff[start:start + _task_size]
+        task = {'fun': fun, 'kwargs': kwargs_name,
+                'cache_db': cache_db is not None, 'items': items, 'profile': profile, 'cwd': os.getcwd(),
+                'reads': [{(method, args): list(getattr(cache_db, method)(*args)) for method, args in reads(item)}
+                          for item in items] if reads is not None else None}
+        name = f'{_run_id}-{_n_stages:03d}-{fun.__name__}-{task_idx:06d}.pkl'
+        write_atomically(_shard_dir / 'tasks' / name, task)
+        pending[name] = start
+    # work on the tasks too while merging the results of the workers
+    results = [None] * len(buff)
+    while len(pending) > 0:
+        claimed = claim_task(_shard_dir, pending, _run_id)
+        if claimed is not None:
+            run_claimed_task(_shard_dir, claimed)
+        merged = False
+        for name in list(pending):
+            result_path = _shard_dir / 'results' / name
+            if not result_path.exists():
+                continue
+            with open(result_path, 'rb') as f:
+                task_results = pickle.load(f)
+            if isinstance(task_results, str):
+                raise RuntimeError(f'shard task {name} failed:\n{task_results}')
+            for item_idx, (result, metrics, writes) in enumerate(task_results):
+                # replay the db writes of the task
+                for method, args, method_kwargs in writes:
+                    getattr(cache_db, method)(*args, **method_kwargs)
+                results[pending[name] + item_idx] = (result, metrics)
+            result_path.unlink()
+            del pending[name]
+            merged = True
+        if claimed is None and not merged:
+            requeue_stale_tasks(_shard_dir, _stale_seconds, _run_id)
+            time.sleep(0.1)
+    (_shard_dir / 'kwargs' / kwargs_name).unlink()
+    return results
+
+
+def write_atomically(path, data, json_format=False):
+    """Pickle (or dump as JSON) data into path, so it only appears once it is complete"""
+    tmp_path = path.with_name(f'.{path.name}.{uuid4().hex}')
+    if json_format:
+        with open(tmp_path, 'w', encoding='UTF-8') as out:
+            json.dump(data, out)
+    else:
+        with open(tmp_path, 'wb') as out:
+            pickle.dump(data, out, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def read_settings(shard_dir):
+    """Return the settings of the current run of shard_dir or None if no run started yet"""
+    try:
+        with open(shard_dir / 'settings.json', encoding='UTF-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def claim_task(shard_dir, names=None, run_id=None):
+    """Claim a task by renaming it into the claimed directory (atomic, so only one worker gets it) or return None"""
+    for path in sorted((shard_dir / 'tasks').glob(f'{run_id}-*.pkl' if run_id is not None else '*.pkl')):
+        if names is not None and path.name not in names:
+            continue
+        try:
+            os.rename(path, shard_dir / 'claimed' / path.name)
+        except FileNotFoundError:  # claimed by another worker
+            continue
+        return path.name
+    return None
+
+
+def requeue_stale_tasks(shard_dir, stale_seconds, run_id):
+    """Put the claimed tasks of run_id back whose worker stopped updating them (the worker probably died)"""
+    for path in (shard_dir / 'claimed').glob(f'{run_id}-*.pkl'):
+        try:
+            if time.time() - path.stat().st_mtime > stale_seconds:
+                os.rename(path, shard_dir / 'tasks' / path.name)
+                print(' * requeued the stale shard task', path.name)
+        except FileNotFoundError:  # finished meanwhile
+            continue
+
+
+def run_claimed_task(shard_dir, name, heartbeat_seconds=None):
+    """Run the items of a claimed task and write their [(result, task metrics, db writes)] into the results"""
+    claimed_path = shard_dir / 'claimed' / name
+    stop = threading.Event()
+    if heartbeat_seconds is not None:
+        # touch the claimed task regularly, so it is not requeued while it runs
+        threading.Thread(target=heartbeat, args=(claimed_path, heartbeat_seconds, stop), daemon=True).start()
+    try:
+        with open(claimed_path, 'rb') as f:
+            task = _TaskUnpickler(f).load()
+        os.chdir(task['cwd'])
+        stage_kwargs = load_stage_kwargs(shard_dir, task['kwargs'])
+        task_results = []
+        for item_idx, item in enumerate(task['items']):
+            kwargs = dict(stage_kwargs)
+            cache_db = None
+            if task['cache_db']:
+                cache_db = kwargs['cache_db'] = ShardCache(task['reads'][item_idx] if task['reads'] else {})
+            result, metrics = run_task(item, lambda args: task['fun'](args, **kwargs), task['profile'])
+            task_results.append((result, metrics, cache_db.writes if cache_db is not None else []))
+    except Exception:
+        task_results = traceback.format_exc()
+    finally:
+        stop.set()
+    # drop the results of a task of a previous run (its task files were deleted by the current run)
+    settings = read_settings(shard_dir)
+    if settings is not None and name.startswith(f'{settings["run_id"]}-'):
+        write_atomically(shard_dir / 'results' / name, task_results)
+    claimed_path.unlink(missing_ok=True)
+
+
+def load_stage_kwargs(shard_dir, name):
+    """Return the kwargs of the stage of a task (only loaded from the kwargs file for the first task of a stage)"""
+    global _stage_kwargs
+    if _stage_kwargs[0] != name:
+        # the kwargs of the previous stage are dropped first
+        _stage_kwargs = (None, None)
+        with open(shard_dir / 'kwargs' / name, 'rb') as f:
+            _stage_kwargs = (name, _TaskUnpickler(f).load())
+    return _stage_kwargs[1]
+
+
+def heartbeat(path, seconds, stop):
+    while not stop.wait(seconds):
+        try:
+            # not path.touch(), which would recreate the task if a new run deleted it
+            os.utime(path)
+        except FileNotFoundError:
+            return
+
+
+class ShardCache:
+    """Serve the cache db reads sent with a task and record its db writes to be replayed by the coordinator"""
+    def __init__(self, reads):
+        self._reads = reads
+        self.writes = []
+
+    def __getattr__(self, method):
+        if method.startswith('stream_'):
+            return lambda *args: iter(self._reads[(method, args)])
+        return lambda *args, **kwargs: self.writes.append((method, args, kwargs))
+
+
+class _TaskUnpickler(pickle.Unpickler):
+    """The functions of the intertext main module are pickled from __main__ by the coordinator"""
+    def find_class(self, module, name):
+        if module == '__main__':
+            module = 'intertext_main'
+        return super().find_class(module, name)
+
+
+def work(shard_dir):
+    """Claim and run the tasks of the current run until the coordinator is finished"""
+    print(f' * shard worker {socket.gethostname()}:{os.getpid()} started')
+    while not (shard_dir / 'finished').exists():
+        # the settings of the current run, as the coordinator may be restarted
+        settings = read_settings(shard_dir)
+        name = claim_task(shard_dir, run_id=settings['run_id']) if settings is not None else None
+        if name is None:
+            time.sleep(0.5)
+            continue
+        run_claimed_task(shard_dir, name, heartbeat_seconds=max(settings['stale_seconds'] / 4, 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the tasks of an intertext run with --shard_dir',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--shard_dir', type=Path, required=True, help='the shard directory of the intertext run')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='the number of worker processes')
+    args = parser.parse_args()
+    # the modules of the tasks are imported from the intertext directory
+    sys.path.insert(0, str(Path(__file__).resolve().parent))
+    workers = [Process(target=work, args=(args.shard_dir.resolve(),))
+               for _ in range(args.processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+if __name__ == '__main__':
+    main()
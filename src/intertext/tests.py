@@ -0,0 +1,25 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import numpy as np
+
+import query_index
+from db_sql import SQLCache
+
+
+# The postings of a hashband should be merged when they span block boundaries (even whole blocks)
+query_index.INDEX_BLOCK_SIZE = 3
+rows = [(1, 0, 0), (2, 0, 1)] + [(5, file_id, 2) for file_id in range(8)] + [(7, 1, 3), (9, 2, 4)]
+with TemporaryDirectory() as tmp_dir:
+    tmp_dir = Path(tmp_dir)
+    cache_db = SQLCache('cache', db_dir=tmp_dir, initialize=True, settings='test')
+    cache_db.write_hashbands(rows)
+    query_index.build_query_index(tmp_dir / 'index', [], {}, {setting: None for setting in query_index.INDEX_SETTINGS},
+                                  cache_db)
+    hashbands = np.load(tmp_dir / 'index' / 'hashbands.npy')
+    offsets = np.load(tmp_dir / 'index' / 'offsets.npy')
+    postings = np.load(tmp_dir / 'index' / 'postings.npy')
+    assert hashbands.tolist() == [1, 2, 5, 7, 9]
+    assert offsets.tolist() == [0, 1, 2, 10, 11, 12]
+    assert postings[offsets[2]:offsets[3]].tolist() == [[file_id, 2] for file_id in range(8)]
+print('all tests passed')
@@ -1,18 +1,61 @@
-from random import randint
+import os
+import re
+import pickle
+from pathlib import Path
+from uuid import uuid4
+from tempfile import TemporaryDirectory
 from multiprocessing import Pool
-from itertools import islice, tee
-from functools import lru_cache, partial
+from itertools import islice, tee, chain
+from functools import lru_cache, partial, wraps
 
-
-from bs4 import BeautifulSoup
+import numpy as np
 from unidecode import unidecode
 
+from profiling import run_task, record_tasks, profiling_enabled, record_tuning, get_rss_mb
+from sharding import sharding_enabled, sharded_map
+
+
+# the file caches of words, windows etc. of each process and their capacity (in files)
+_file_caches = []
+_file_cache_size = 1024
+
+
+def file_cache(fun):
+    """lru_cache a function of a file, with a capacity which can be changed by set_file_cache_size()"""
+    cache = {'cached': lru_cache(maxsize=_file_cache_size)(fun)}
+
+    @wraps(fun)
+    def wrapper(*args):
+        return cache['cached'](*args)
+    wrapper.resize = lambda maxsize: cache.update(cached=lru_cache(maxsize=maxsize)(fun))
+    _file_caches.append(wrapper)
+    return wrapper
+
+
+def set_file_cache_size(maxsize):
+    """Set the number of files of each file cache (the caches are cleared)"""
+    global _file_cache_size
+    _file_cache_size = maxsize
+    for wrapper in _file_caches:
+        wrapper.resize(maxsize)
+
 
 def ngrams(it, n):
     return zip(*(islice(it, i, None) for i, it in enumerate(tee(it, n))))
 
 
-@lru_cache(maxsize=1024)
+def chunked_iterator(iterable, n):
+    # Original source:
+    # https://stackoverflow.com/questions/8991506/iterate-an-iterator-by-chunks-of-n-in-python/29524877#29524877
+    it = iter(iterable)
+    try:
+        while True:
+            yield list(chain((next(it),), islice(it, n-1)))
+    except StopIteration:
+        return
+
+
+@file_cache
 def get_windows(path, strip_diacritics, window_length, slide_length):
     """Given a file path return a list of strings from that file"""
     words = get_words(path, strip_diacritics, False)
@@ -23,79 +66,202 @@ def get_windows(path, strip_diacritics, window_length, slide_length):
     return buff
 
 
-@lru_cache(maxsize=1024)
-def get_words(path, strip_diacritics, display):
-    """Given a file path return a list of strings from that file"""
+def get_window_bytes(path, strip_diacritics, window_length, slide_length):
+    """Given a file path return (lowercase UTF-8 bytes of the words, start and end byte offsets of the windows)"""
+    words = get_words(path, strip_diacritics, False)
+    # lowercase and encode each distinct word only once (lower() does not cross whitespaces)
+    encoded = {word: word.lower().encode('UTF-8') for word in set(words)}
+    words = [encoded[word] for word in words]
+    # the words are separated by one space byte as in get_windows()
+    word_starts = np.cumsum([0] + [len(word) + 1 for word in words[:-1]], dtype=np.int64)
+    word_ends = word_starts + np.array([len(word) for word in words], dtype=np.int64)
+    first_words = np.arange(0, max(len(words) - window_length + 1, 0), slide_length)
+    return b' '.join(words), word_starts[first_words], word_ends[first_words + window_length - 1]
+
+
+@file_cache
+def get_tokens(path):
+    """Given a file path return (words, start offsets of words, number of newlines after words) from that file"""
     with open(path, encoding='UTF-8') as f:
         f = f.read()
-    # optionally remove diacritics
+    # the odd elements are the words (as str.split() would return them), the even ones are the whitespaces around them
+    parts = re.split(r'(\S+)', f)
+    offsets = np.cumsum([0] + [len(part) for part in parts[:-1]])
+    words = parts[1::2]
+    word_starts = offsets[1::2]
+    newlines = np.array([whitespace.count('\n') for whitespace in parts[2::2]], dtype=np.uint32)
+    return words, word_starts, newlines
+
+
+@file_cache
+def get_words(path, strip_diacritics, display):
+    """Given a file path return a list of strings from that file"""
+    words, _, newlines = get_tokens(path)
+    # optionally remove diacritics (once for each distinct word)
     if strip_diacritics and not display:
-        f = unidecode(f)
+        stripped = {word: unidecode(word) for word in set(words)}
+        return [stripped[word] for word in words]
     if not display:
-        return f.split()
-    # optionally format the list of words for display in the web viewer
+        return words
+    # optionally format the list of words for display in the web viewer (prevent more than two consecutive brs)
     else:
-        lines = f.replace('\n', ' __NEWLINE__ ').split()
-        formatted = []
-        for idx, i in enumerate(lines):
-            if i == '__NEWLINE__':
-                # prevent more than two consecutive brs
-                if len(formatted) > 0 and not formatted[-1].endswith('<br/><br/>'):
-                    formatted[-1] += '<br/>'
-            else:
-                formatted.append(i)
-        return formatted
-
-
-@lru_cache(maxsize=1024)
+        return [word + '<br/>' * int(min(n, 2)) for word, n in zip(words, newlines)]
+
+
+@file_cache
 def get_window_map(path, xml_page_tag, xml_page_attr, slide_length):
-    """Get a mapping from window id to window metadata, including page id"""
-    xml_page_tag = xml_page_tag.lower()
-    xml_page_attr = xml_page_attr.lower() if xml_page_attr else None
-    # read the text document
+    """Get a mapping from window id to page id as (page ids, array of page indices (-1 before the first page))"""
+    # read the text document and the start offsets of its words
     with open(path, encoding='UTF-8') as f:
-        f = f.read().lower()
-    # split on page breaks using string operations
-    pagebreak = f'{randint(0, 2 ** 32)}_$PB$_{randint(0, 2 ** 32)}'.lower()
-    f = f.replace(f'<{xml_page_tag} ', pagebreak)
-    f = f.replace(f'<{xml_page_tag}/>', pagebreak)
-    pages = f.split(pagebreak)
-    # populate the mapping from window index to page id d[window_index] = {page_id, ...}
-    d = {}
-    window_id = 0
-    # skip content leading up to first page
-    for page_index, page in enumerate(pages[1:]):
+        f = f.read()
+    _, word_starts, _ = get_tokens(path)
+    # scan the page tags with their word offsets
+    page_ids = []
+    page_starts = []
+    page_tags = list(re.finditer(f'<{re.escape(xml_page_tag)}(?=[\\s/>])([^>]*)>', f, flags=re.IGNORECASE))
+    page_close_tag = re.compile(f'</{re.escape(xml_page_tag)}', flags=re.IGNORECASE)
+    page_attr = re.compile(f'{re.escape(xml_page_attr)}=["\']?([^"\'\\s/>]*)', flags=re.IGNORECASE) \
+        if xml_page_attr else None
+    for page_index, tag in enumerate(page_tags):
+        next_start = page_tags[page_index + 1].start() if page_index + 1 < len(page_tags) else len(f)
+        page_close = page_close_tag.search(f, tag.end(), next_start)
         # handle case of page id specified in an attribute
-        if xml_page_attr:
-            tag = page.split('>')[0]
-            page_id = tag.split('{}='.format(xml_page_attr))[1].split(' ')[0]
-            page_id = page_id.replace('"', '').replace("'", '')
-            page_id = page_id.rstrip('/>')
+        if page_attr is not None:
+            attr = page_attr.search(tag.group(1))
+            page_id = attr.group(1) if attr else ''
         # hande case of page id between tags
-        elif '</' + xml_page_tag in page:
-            page_id = page.split('</' + xml_page_tag)[0]
-            if '>' in page_id:
-                page_id = page_id.split('>')[1]
+        elif page_close is not None:
+            page_id = f[tag.end():page_close.start()].split('>')[-1]
         # handle case of sequential pages without identification (self-closing tags)
         else:
             page_id = page_index
         # clean the page id
-        page_id = str(page_id).strip()
-        # remove the lead tag
-        page = '>'.join(page.split('>')[1:])
-        soup = BeautifulSoup(page, 'html.parser')
-        text = soup.get_text() if soup else ''
-        words = text.split()
-        for word_index, word in enumerate(words):
-            if word_index and (word_index % slide_length == 0):
-                window_id += 1
-            d[window_id] = page_id
-    return d
+        page_ids.append(str(page_id).strip().lower())
+        # the id of the first word which starts in the page tag
+        page_starts.append(np.searchsorted(word_starts, tag.start()))
+    # populate the mapping from window index to page index by the first word of each window
+    window_starts = np.arange(0, max(len(word_starts), 1), slide_length)
+    window_pages = np.searchsorted(np.array(page_starts, dtype=np.int64), window_starts, side='right') - 1
+    return tuple(page_ids), window_pages.astype(np.int32)
+
+
+def get_max_file_matches(n_windows_a, n_windows_b, max_file_sim):
+    """Return the number of matches above which a file pair is too similar to be retained (None if unlimited)"""
+    if max_file_sim is None:
+        return None
+    # max_file_sim is the percentage of the windows of the shorter file
+    return min(n_windows_a, n_windows_b) * max_file_sim / 100
+
+
+# the worker pool of the run (reused by all stages) and the read-only values shared with its workers
+_pool = None
+_processes = None
+_chunksize = None
+_memory_budget = None
+_base_rss_mb = 0.0
+_shared_dir = None
+_initial_shared = {}
+# in the main process: id(value) -> (value, _Shared placeholder); in the workers: key -> value
+_shared = {}
+
+
+def start_pool(processes=None, chunksize=None, memory_budget=None, **shared):
+    """Start the worker pool of the run, the shared values are sent to each worker once (instead of with each task)
+
+    With a memory_budget (MB), the pool is restarted with fewer processes after a stage if the measured memory of
+     the workers would exceed it.
+    """
+    global _pool, _processes, _chunksize, _memory_budget, _base_rss_mb, _shared_dir, _initial_shared
+    stop_pool()
+    _processes = processes or os.cpu_count()
+    _chunksize = chunksize
+    _memory_budget = memory_budget
+    # the memory of the main process is shared with the workers after the fork
+    _base_rss_mb = get_rss_mb()
+    _shared_dir = TemporaryDirectory()
+    _initial_shared = shared
+    for key, value in shared.items():
+        _shared[id(value)] = (value, _Shared(key, None))
+    _pool = Pool(_processes, initializer=_init_worker, initargs=(shared,))
+
+
+def fit_pool_to_memory_budget(task_results):
+    """Restart the pool with fewer processes if the measured peak memory of the workers exceeds the memory budget"""
+    global _pool, _processes
+    worker_mb = max([metrics['peak_rss_mb'] for _, metrics in task_results] + [0]) - _base_rss_mb
+    processes = int(max((_memory_budget - get_rss_mb()) // max(worker_mb, 1), 1))
+    if processes < _processes:
+        print(f' * the workers used up to {worker_mb:.0f} MB; restarting the pool with fewer processes')
+        record_tuning({'processes': processes, 'measured_worker_mb': round(worker_mb, 1)})
+        _pool.close()
+        _pool.join()
+        _processes = processes
+        _pool = Pool(_processes, initializer=_init_worker, initargs=(_initial_shared,))
+
+
+def share(**shared):
+    """Share values computed after the pool was started with its workers (each worker loads them once)"""
+    for key, value in shared.items():
+        if _pool is None or value is None:
+            continue
+        path = Path(_shared_dir.name) / f'{key}-{uuid4().hex}.pkl'
+        with open(path, 'wb') as out:
+            pickle.dump(value, out, protocol=pickle.HIGHEST_PROTOCOL)
+        _shared[id(value)] = (value, _Shared(key, path))
+
+
+def stop_pool():
+    """Stop the worker pool of the run"""
+    global _pool, _shared_dir, _initial_shared
+    _initial_shared = {}
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+        _pool = None
+        _shared_dir.cleanup()
+        _shared_dir = None
+    _shared.clear()
+
+
+def _init_worker(shared):
+    _shared.clear()
+    _shared.update(shared)
+
+
+class _Shared:
+    """Placeholder of a shared value in the tasks sent to the workers"""
+    def __init__(self, key, path):
+        self.key = key
+        self.path = path
+
+    def load(self):
+        if self.path is not None and self.path not in _shared:
+            with open(self.path, 'rb') as f:
+                _shared[self.path] = pickle.load(f)
+        return _shared[self.path if self.path is not None else self.key]
+
+
+def _run_shared(args, fun, kwargs):
+    """Run fun(args, **kwargs) in a worker with the placeholders of the shared values replaced"""
+    return fun(args, **{key: value.load() if isinstance(value, _Shared) else value for key, value in kwargs.items()})
 
 
 def parallel_map(fun, buff, **kwargs):
-    process_pool = Pool()
-    for _ in process_pool.map(partial(fun, **kwargs), buff):
-        pass
-    process_pool.close()
-    process_pool.join()
+    # the tasks are run by the workers of all nodes if sharding
+    if sharding_enabled():
+        return record_tasks(sharded_map(fun, buff, kwargs, profiling_enabled()))
+    if _pool is None:
+        process_pool = Pool()
+        # each task also returns its metrics which are recorded to the current stage of the metrics report
+        results = process_pool.map(partial(run_task, fun=partial(fun, **kwargs), profile=profiling_enabled()), buff)
+        process_pool.close()
+        process_pool.join()
+        return record_tasks(results)
+    # the shared values are not pickled with the tasks
+    kwargs = {key: _shared[id(value)][1] if id(value) in _shared and _shared[id(value)][0] is value else value
+              for key, value in kwargs.items()}
+    fun = partial(_run_shared, fun=fun, kwargs=kwargs)
+    results = _pool.map(partial(run_task, fun=fun, profile=profiling_enabled()), buff, _chunksize)
+    if _memory_budget is not None:
+        fit_pool_to_memory_budget(results)
+    return record_tasks(results)
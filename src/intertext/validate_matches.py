@@ -1,25 +1,35 @@
 from difflib import SequenceMatcher
 
-from utils import get_windows, parallel_map
+from utils import get_windows, get_max_file_matches, parallel_map
+from sharding import shard_reads
 
 
 # Only this function is public in this file!
-def validate_all_matches(infiles, strip_diacritics, window_length, slide_length, min_sim, cache_db):
+def validate_all_matches(infiles, strip_diacritics, window_length, slide_length, min_sim, max_file_sim, banishing,
+                         cache_db):
     """Run match validations and yield [a_file,b_file,a_window,b_window]"""
+    # skip the file pairs validated by a previous (interrupted) run with the same settings
+    done = {row[0] for row in cache_db.stream_done_tasks('validate')}
     pairs = [(infiles[file_id_a], infiles[file_id_b], file_id_a, file_id_b)
-             for file_id_a, file_id_b in cache_db.stream_candidate_file_id_pairs()]
+             for file_id_a, file_id_b in cache_db.stream_candidate_file_id_pairs()
+             if f'{file_id_a}-{file_id_b}' not in done]
+    # banishing deletes matches before the max_file_sim check, so the validation can not be stopped early then
     parallel_map(validate_file_matches, pairs, strip_diacritics=strip_diacritics, min_sim=min_sim, cache_db=cache_db,
-                 window_length=window_length, slide_length=slide_length)
+                 window_length=window_length, slide_length=slide_length,
+                 max_file_sim=max_file_sim if not banishing else None)
 
 
-def validate_file_matches(pairs, strip_diacritics, min_sim, cache_db, window_length, slide_length):
+@shard_reads(lambda pairs: [('stream_matching_candidate_windows', (pairs[2], pairs[3]))])
+def validate_file_matches(pairs, strip_diacritics, min_sim, cache_db, window_length, slide_length, max_file_sim):
     """Validate the matches for a single file pair and return [a_file,b_file,a_window,b_window]"""
     file_path_a, file_path_b, file_id_a, file_id_b = pairs
+    file_b_windows = get_windows(file_path_b, strip_diacritics, window_length, slide_length)
+    file_a_windows = get_windows(file_path_a, strip_diacritics, window_length, slide_length)
+    # pairs with more matches are dropped when formatting, so it is enough to find one match over the limit
+    max_file_matches = get_max_file_matches(len(file_a_windows), len(file_b_windows), max_file_sim)
     matches = []
     for file_id_a, file_id_b, window_id_a, window_id_b \
             in cache_db.stream_matching_candidate_windows(file_id_a, file_id_b):
-        file_b_windows = list(get_windows(file_path_b, strip_diacritics, window_length, slide_length))
-        file_a_windows = list(get_windows(file_path_a, strip_diacritics, window_length, slide_length))
         try:
             text_a = file_a_windows[window_id_a]
             text_b = file_b_windows[window_id_b]
@@ -28,12 +38,23 @@ def validate_file_matches(pairs, strip_diacritics, min_sim, cache_db, window_len
             print(file_id_a, window_id_a, len(file_a_windows), file_path_a)
             print(file_id_b, window_id_b, len(file_b_windows), file_path_b)
             continue
-        sim = SequenceMatcher(a=text_a, b=text_b, autojunk=False).ratio() * 100
-        if sim >= min_sim:
-            # remove matches with predominance of single character words
-            a_singles = sum(int(len(i) == 1) for i in text_a.split())
-            b_singles = sum(int(len(i) == 1) for i in text_b.split())
-            if a_singles < (window_length * 0.75) and b_singles < (window_length * 0.75):
-                matches.append([file_id_a, file_id_b, window_id_a, window_id_b, int(sim)])
-    if matches:
-        cache_db.write_matches(matches)
+        sim = get_window_similarity(text_a, text_b, min_sim, window_length)
+        if sim is not None:
+            matches.append([file_id_a, file_id_b, window_id_a, window_id_b, sim])
+            if max_file_matches is not None and len(matches) > max_file_matches:
+                print(' * file pair', file_id_a, file_id_b, 'has >= max_file_sim; stopping validation!')
+                break
+    # the file pair is marked done together with its matches
+    cache_db.write_matches(matches, done=[('validate', f'{file_id_a}-{file_id_b}')])
+
+
+def get_window_similarity(text_a, text_b, min_sim, window_length):
+    """Return the similarity of two windows as int if they match (None otherwise)"""
+    sim = SequenceMatcher(a=text_a, b=text_b, autojunk=False).ratio() * 100
+    if sim >= min_sim:
+        # remove matches with predominance of single character words
+        a_singles = sum(int(len(i) == 1) for i in text_a.split())
+        b_singles = sum(int(len(i) == 1) for i in text_b.split())
+        if a_singles < (window_length * 0.75) and b_singles < (window_length * 0.75):
+            return int(sim)
+    return None
@@ -1,12 +1,21 @@
+import os
 from zlib import crc32
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 from tqdm import tqdm
 
 _ROOT_DIR = Path(__file__).parent
 _FINGERPRINT_BATCH_SIZE = int(1e5)
+_PERMUTATION_BLOCK_SIZE = 512  # rows of n_perm uint64 values computed at once on the CPU (~1 MB for n_perm=256)
 _MIN_CUDA_SIZE = int(1e4)
+_SIMILARITY_TILE_SIZE = 2 ** 24  # bytes of query x key x n_perm comparisons computed at once by a CPU thread
+_SIMILARITY_BLOCK_SIZE = 2 ** 24  # bytes of query x key equal counts computed at once on the CPU
+_VERIFY_BLOCK_SIZE = 2 ** 12  # candidate pairs compared at once by a CPU thread when clustering
+_CLUSTER_TILE_GROUP_SIZE = 64  # band groups larger than this are compared in tiles when clustering
+_CLUSTER_CANDIDATE_RATIO = 2  # all pairs are compared in tiles if the bands give more than half of them
+_HASH_FAMILIES = ('universal', 'multiply_shift')
 
 try:
     import cupy as cp
@@ -34,12 +43,31 @@ class VectorizedMinHash:
     'mirror=True' doubles the length of the fingerprint for a given n_perm by taking
     the max of each perm column as well as the min. Saves processing time and
     improves accuracy, while still allowing merging with a min operation.
+
+    'hash_family' selects the permutation functions: 'universal' is (a * h + b) % p
+    with the Mersenne prime p = 2**61 - 1 (as in datasketch), 'multiply_shift' is
+    (a * h + b) >> 32 with random 64-bit a (odd) and b, where the uint64 overflow
+    is part of the hash function, so no (slow) 64-bit modulo is needed.
+    Fingerprints of different hash families are not comparable.
+
+    'one_permutation=True' uses one permutation hashing (OPH): each hash value is
+    permuted only once and the result is split into n_perm bins by its high bits,
+    keeping the min of each bin. Empty bins are filled with optimal densification
+    (the value of the first non-empty bin in a fixed random sequence of bins per
+    empty bin), so fingerprinting is O(len(h) + n_perm) instead of O(len(h) * n_perm).
+    Fingerprints of OPH and the n_perm permutations are not comparable and the
+    cardinality estimate is not calibrated for OPH fingerprints.
     """
 
-    def __init__(self, n_perm=32, mirror=True, seed=1, card_bias_coef=_BIAS_COEF, card_bias_scaler=None):
+    def __init__(self, n_perm=32, mirror=True, seed=1, card_bias_coef=_BIAS_COEF, card_bias_scaler=None,
+                 hash_family='universal', one_permutation=False):
+        if hash_family not in _HASH_FAMILIES:
+            raise ValueError(f'hash_family must be in {_HASH_FAMILIES}')
         self.n_perm = n_perm
         self.mirror = mirror
         self.seed = seed
+        self.hash_family = hash_family
+        self.one_permutation = one_permutation
 
         self._mersenne_prime = (1 << 61) - 1
         self._max_hash = (1 << 32) - 1
@@ -49,9 +77,19 @@ class VectorizedMinHash:
         # Create parameters for a random bijective permutation function
         # that maps a 32-bit hash value to another 32-bit hash value.
         # http://en.wikipedia.org/wiki/Universal_hashing
-        self.permutations = np.array([(self.generator.randint(1, self._mersenne_prime, dtype=np.uint64),
-                                       self.generator.randint(0, self._mersenne_prime, dtype=np.uint64))
-                                      for _ in range(self.n_perm)], dtype=np.uint64).T
+        n_hashes = 1 if self.one_permutation else self.n_perm
+        if self.hash_family == 'universal':
+            self.permutations = np.array([(self.generator.randint(1, self._mersenne_prime, dtype=np.uint64),
+                                           self.generator.randint(0, self._mersenne_prime, dtype=np.uint64))
+                                          for _ in range(n_hashes)], dtype=np.uint64).T
+        else:
+            # Multiply-shift hashing: a must be odd, the high 32 bits of the 64-bit result are the hash value
+            self.permutations = self.generator.randint(0, 1 << 64, size=(2, n_hashes), dtype=np.uint64)
+            self.permutations[0] |= np.uint64(1)
+
+        if self.one_permutation:
+            # The fixed random sequence of bins to borrow from for each empty bin (optimal densification)
+            self.densification_bins = self.generator.randint(0, self.n_perm, size=(self.n_perm, self.n_perm))
 
         # Compute bias scaler for cardinality estimate (a function of n_perm)
         if card_bias_scaler is not None:
@@ -61,14 +99,26 @@ class VectorizedMinHash:
         else:
             self.card_bias_scaler = None
 
+    def _permute(self, h, a, b, xp=np):
+        """
+        Applies the n_perm hash functions to a column of hash values and returns
+        the (len(h), n_perm) matrix of the permuted values (in uint64).
+        """
+        if self.hash_family == 'universal':
+            return xp.bitwise_and((a * h + b) % xp.uint64(self._mersenne_prime), xp.uint64(self._max_hash))
+        return (a * h + b) >> xp.uint64(32)
+
     def _batch_fingerprint(self, h, cuda='auto'):
         """
         Takes a sequence of hash values and creates a minHash fingerprint
         of length n_perm or 2*n_perm if mirror=True.
         """
-        h = np.array(h, dtype=np.uint32)[:, np.newaxis]
+        h = np.array(h, dtype=np.uint32).astype(np.uint64)[:, np.newaxis]
         a, b = self.permutations
 
+        if self.one_permutation:
+            return self._batch_oph_fingerprint(h, a, b)
+
         if cuda == 'auto':
             cuda = _CUDA and (len(h) >= _MIN_CUDA_SIZE)
 
@@ -77,12 +127,9 @@ class VectorizedMinHash:
             h = cp.asarray(h)
             a = cp.asarray(a)
             b = cp.asarray(b)
-            p = cp.asarray(np.uint64(self._mersenne_prime))
-            m = cp.asarray(np.uint64(self._max_hash))
 
-            # Run same universal hashing algorithm as cpu version
-            capital_h = cp.tile(h, self.n_perm)
-            capital_h = cp.bitwise_and((a * capital_h + b) % p, m)
+            # Run same hashing algorithm as cpu version (broadcast over the permutations)
+            capital_h = self._permute(h, a, b, xp=cp)
 
             f = cp.asnumpy(capital_h.min(axis=0))
             if self.mirror:
@@ -94,25 +141,118 @@ class VectorizedMinHash:
             cp.get_default_memory_pool().free_all_blocks()
 
         else:
-            capital_h = np.tile(h, self.n_perm)
-            capital_h = np.bitwise_and((a * capital_h + b) % self._mersenne_prime, np.uint64(self._max_hash))
-            f = capital_h.min(axis=0)
+            # Compute the permutations in cache-sized blocks of rows and keep the running min (and max)
+            f = np.full(self.n_perm, self._max_hash, dtype=np.uint64)
+            f_max = np.zeros(self.n_perm, dtype=np.uint64)
+            for i in range(0, len(h), _PERMUTATION_BLOCK_SIZE):
+                capital_h = self._permute(h[i:i + _PERMUTATION_BLOCK_SIZE], a, b)
+                np.minimum(f, capital_h.min(axis=0), out=f)
+                if self.mirror:
+                    np.maximum(f_max, capital_h.max(axis=0), out=f_max)
 
             if self.mirror:
-                f_mirrored = capital_h.max(axis=0)
-                f_mirrored = self._max_hash - f_mirrored
+                f_mirrored = np.uint64(self._max_hash) - f_max
                 f = np.hstack([f, f_mirrored])
 
         return f.astype(np.uint32)
 
-    def fingerprint(self, h, batch_size=_FINGERPRINT_BATCH_SIZE, cuda='auto'):
+    def _batch_oph_fingerprint(self, h, a, b):
+        """
+        Creates a one permutation hashing fingerprint (without densification,
+        the empty bins are _max_hash) of length n_perm or 2*n_perm if mirror=True.
+        """
+        # The high bits of v * n_perm are the bin, v itself is kept as the value (all of its bits are uniform,
+        # which b-bit minhashes rely on, unlike the low bits of v * n_perm)
+        v = self._permute(h, a, b)[:, 0]
+        bins = ((v * np.uint64(self.n_perm)) >> np.uint64(32)).astype(np.intp)
+
+        f = np.full(self.n_perm, self._max_hash, dtype=np.uint64)
+        np.minimum.at(f, bins, v)
+        if self.mirror:
+            f_max = np.zeros(self.n_perm, dtype=np.uint64)
+            np.maximum.at(f_max, bins, v)
+            f_mirrored = np.uint64(self._max_hash) - f_max
+            f = np.hstack([f, f_mirrored])
+
+        return f.astype(np.uint32)
+
+    def densify(self, fingerprints):
+        """
+        Fills the empty bins of one permutation hashing fingerprints (a single
+        fingerprint or a matrix of them) from the first non-empty bin of their
+        densification sequence (or the next non-empty bin if the whole sequence
+        is empty). Densifying many fingerprints at once is much faster.
+        """
+        f = fingerprints.reshape(-1, fingerprints.shape[-1] // self.n_perm, self.n_perm)
+        # The mirrored half has the same empty bins
+        empty = f[:, 0, :] == self._max_hash
+        source = np.broadcast_to(np.arange(self.n_perm), empty.shape).copy()
+        # The (row, bin) pairs of the empty bins still to be filled (completely empty fingerprints stay empty)
+        rows, bins = np.nonzero(empty & ~empty.all(axis=1, keepdims=True))
+
+        for attempt_bins in np.ascontiguousarray(self.densification_bins.T):
+            if len(rows) == 0:
+                break
+            candidates = attempt_bins[bins]
+            found = ~empty[rows, candidates]
+            source[rows[found], bins[found]] = candidates[found]
+            rows, bins = rows[~found], bins[~found]
+
+        for row, empty_bin in zip(rows, bins):
+            non_empty_bins = np.flatnonzero(~empty[row])
+            source[row, empty_bin] = non_empty_bins[np.searchsorted(non_empty_bins, empty_bin) % len(non_empty_bins)]
+
+        f = np.take_along_axis(f, source[:, np.newaxis, :], axis=2)
+
+        return f.reshape(fingerprints.shape)
+
+    def fingerprint(self, h, batch_size=_FINGERPRINT_BATCH_SIZE, cuda='auto', densify=True):
         """
         Computes a fingerprint in batches. Useful if the number of hashes
         is very very high or memory is constrained.
+
+        One permutation hashing fingerprints are densified after merging the
+        batches unless densify=False (e.g. to union them later).
         """
         fingerprints = [self._batch_fingerprint(h[i:i + batch_size], cuda=cuda) for i in range(0, len(h), batch_size)]
 
-        return union(fingerprints)
+        f = union(fingerprints)
+        if self.one_permutation and densify:
+            f = self.densify(f)
+
+        return f
+
+    def fingerprints(self, hs, cuda='auto'):
+        """
+        Computes the fingerprints of a sequence of hash value sequences as a
+        matrix. One permutation hashing fingerprints are computed for all sets
+        at once, which avoids the per-set overhead for many small sets.
+        """
+        if len(hs) == 0:
+            return np.zeros((0, self.n_perm * (2 if self.mirror else 1)), dtype=np.uint32)
+
+        if not self.one_permutation:
+            return np.vstack([self.fingerprint(h, cuda=cuda) for h in hs])
+
+        lengths = np.array([len(h) for h in hs], dtype=np.intp)
+        set_ids = np.repeat(np.arange(len(hs)), lengths)
+        h = np.concatenate([np.asarray(h, dtype=np.uint32) for h in hs] + [np.array([], dtype=np.uint32)])
+        a, b = self.permutations
+
+        # Same as _batch_oph_fingerprint with a (set, bin) index to the flattened fingerprint matrix
+        v = self._permute(h.astype(np.uint64)[:, np.newaxis], a, b)[:, 0]
+        cells = set_ids * self.n_perm + ((v * np.uint64(self.n_perm)) >> np.uint64(32)).astype(np.intp)
+
+        f = np.full(len(hs) * self.n_perm, self._max_hash, dtype=np.uint64)
+        np.minimum.at(f, cells, v)
+        f = f.reshape(len(hs), self.n_perm)
+        if self.mirror:
+            f_max = np.zeros(len(hs) * self.n_perm, dtype=np.uint64)
+            np.maximum.at(f_max, cells, v)
+            f_mirrored = np.uint64(self._max_hash) - f_max.reshape(len(hs), self.n_perm)
+            f = np.hstack([f, f_mirrored])
+
+        return self.densify(f.astype(np.uint32))
 
     def cardinality(self, fingerprints):
         """
@@ -139,6 +279,9 @@ def union(fingerprints):
     Merge fingerprints to create a new fingerprint. Mathematically equivalent
     to set union. Functionally equivalent output to concatenating hash value
     sequences before fingerprinting.
+
+    One permutation hashing fingerprints should be merged without densification
+    (fingerprint(h, densify=False)) and densified afterwards with densify().
     """
     h = np.vstack(fingerprints)
     assert h.shape[0] == len(fingerprints)
@@ -168,7 +311,15 @@ def jaccard_matrix(fingerprints):
     return X
 
 
-def jaccard_similarities(query_fingerprints, key_fingerprints=None, cuda='auto'):
+def jaccard_similarities(query_fingerprints, key_fingerprints=None, cuda='auto', n_threads=None):
+    """
+    Yields the estimated jaccard similarities of each query fingerprint to all
+    key fingerprints.
+
+    On the CPU, the similarities are computed for blocks of queries at once in
+    query x key tiles by n_threads threads (all cores by default), as NumPy
+    releases the GIL.
+    """
     if isinstance(query_fingerprints, np.ndarray):
         query_fingerprints = [query_fingerprints]
     if key_fingerprints is None:
@@ -187,37 +338,60 @@ def jaccard_similarities(query_fingerprints, key_fingerprints=None, cuda='auto')
         capital_f_k = cp.asarray(capital_f_k)
         capital_f_q = cp.asarray(capital_f_q)
 
-    for f_q in tqdm(capital_f_q, delay=1, desc='Computing Jaccard similarities'):
-        jaccard_val = (capital_f_k == f_q).mean(axis=1)
-        if cuda:
+        for f_q in tqdm(capital_f_q, delay=1, desc='Computing Jaccard similarities'):
+            jaccard_val = (capital_f_k == f_q).mean(axis=1)
             jaccard_val = cp.asnumpy(jaccard_val)
-        yield jaccard_val
+            yield jaccard_val
 
-
-def jaccard_match(query_fingerprints, key_fingerprints, cuda='auto'):
+    else:
+        # Blocks of queries with (uint16) equal counts of all keys in _SIMILARITY_BLOCK_SIZE bytes
+        block_size = max(1, _SIMILARITY_BLOCK_SIZE // (2 * max(n_k, 1)))
+        with tqdm(total=n_q, delay=1, desc='Computing Jaccard similarities') as pbar, \
+                ThreadPoolExecutor(_n_threads(n_threads)) as executor:
+            for i in range(0, n_q, block_size):
+                counts = _equal_counts(capital_f_q[i:i + block_size], capital_f_k, executor)
+                for count in counts:
+                    # Same as the mean of the equal columns
+                    yield count / n_perm_q
+                pbar.update(len(counts))
+
+
+def jaccard_match(query_fingerprints, key_fingerprints, cuda='auto', n_threads=None):
     keys = np.array(range(len(key_fingerprints)))
-    for jaccard_val in jaccard_similarities(query_fingerprints, key_fingerprints, cuda=cuda):
+    for jaccard_val in jaccard_similarities(query_fingerprints, key_fingerprints, cuda=cuda, n_threads=n_threads):
         yield keys[jaccard_val == jaccard_val.max()]
 
 
-def jaccard_cluster(fingerprints, threshold=0.9, cuda='auto'):
+def jaccard_cluster(fingerprints, threshold=0.9, cuda='auto', n_threads=None):
+    """
+    Single linkage clustering of fingerprints: fingerprints with an estimated
+    jaccard similarity >= threshold are in the same cluster. Returns the
+    cluster id of each fingerprint, which is the index of the first
+    fingerprint of its cluster.
+
+    On the CPU, only the candidate pairs that agree on a band of the
+    fingerprint columns are compared (by n_threads threads). Pairs over the
+    threshold differ in at most m columns, so splitting the columns into
+    m + 1 bands guarantees that they agree on at least one band (no pair
+    is missed). The large groups of a band are compared in tiles, and if
+    the bands give more candidate pairs than a fraction of all pairs (with
+    similarities close to a low threshold), all pairs are compared in
+    tiles instead.
+    """
     capital_f = np.vstack(fingerprints)
     n, n_perm = capital_f.shape
 
-    # Initializer clusters as singletons
-    ids = np.array(range(n))
-    cluster_ids = np.array(range(n))
-
     if cuda == 'auto':
         cuda = _CUDA and (len(capital_f) >= _MIN_CUDA_SIZE)
 
-    if cuda:
-        capital_f = cp.asarray(capital_f)
-        ids = cp.asarray(ids)
-        cluster_ids = cp.asarray(cluster_ids)
-        xp = cp
-    else:
-        xp = np
+    if not cuda:
+        return _lsh_jaccard_cluster(capital_f, threshold, n_threads)
+
+    # Initializer clusters as singletons
+    ids = cp.asarray(np.array(range(n)))
+    cluster_ids = cp.asarray(np.array(range(n)))
+    capital_f = cp.asarray(capital_f)
+    xp = cp
 
     with tqdm(total=n, delay=1, desc='Computing Jaccard clusters') as pbar:
         for i in range(n):
@@ -265,12 +439,183 @@ def jaccard_cluster(fingerprints, threshold=0.9, cuda='auto'):
                 pbar.update(n - i)
                 break
 
-    if cuda:
-        cluster_ids = cp.asnumpy(cluster_ids)
-        # Clear gpu cache
-        # cp.get_default_memory_pool().free_all_blocks()
+    cluster_ids = cp.asnumpy(cluster_ids)
+    # Clear gpu cache
+    # cp.get_default_memory_pool().free_all_blocks()
+
+    # Use the first fingerprint of each cluster as its id (as on the CPU)
+    _, first_ids, inverse = np.unique(cluster_ids, return_index=True, return_inverse=True)
+    return first_ids[inverse]
 
-    return cluster_ids
+
+def _n_threads(n_threads):
+    return n_threads if n_threads is not None else (os.cpu_count() or 1)
+
+
+def _equal_counts(capital_f_q, capital_f_k, executor):
+    """
+    Counts the equal columns of each query and key fingerprint as a
+    (n_queries, n_keys) matrix, computed in tiles of keys by the threads of
+    executor.
+    """
+    n_q, n_perm = capital_f_q.shape
+    n_k = capital_f_k.shape[0]
+    dtype = np.uint16 if n_perm < 2 ** 16 else np.uint32
+    counts = np.zeros((n_q, n_k), dtype=dtype)
+    # The (n_queries, keys of the tile, n_perm) comparisons of a tile take _SIMILARITY_TILE_SIZE bytes
+    tile_size = max(1, _SIMILARITY_TILE_SIZE // (max(n_q, 1) * n_perm))
+
+    def count_tile(start):
+        tile = slice(start, start + tile_size)
+        np.sum(capital_f_q[:, np.newaxis, :] == capital_f_k[np.newaxis, tile, :], axis=2, dtype=dtype,
+               out=counts[:, tile])
+
+    list(executor.map(count_tile, range(0, n_k, tile_size)))
+    return counts
+
+
+def _lsh_jaccard_cluster(capital_f, threshold, n_threads=None):
+    """
+    CPU implementation of jaccard_cluster() with banded candidate pairs
+    """
+    n, n_perm = capital_f.shape
+    # The same comparison as on the GPU: count / n_perm >= threshold
+    min_count = int(np.ceil(threshold * n_perm))
+    while min_count > 0 and (min_count - 1) / n_perm >= threshold:
+        min_count -= 1
+    while min_count <= n_perm and min_count / n_perm < threshold:
+        min_count += 1
+    if min_count <= 0:
+        return np.zeros(n, dtype=int)
+
+    # Identical fingerprints are always in the same cluster, so only the distinct ones are compared
+    capital_f, first_ids, inverse = np.unique(capital_f, axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    n_distinct = len(capital_f)
+    # Cluster roots (the smallest index of each cluster) as a union-find forest kept fully compressed
+    parents = np.arange(n_distinct)
+
+    if min_count <= n_perm:
+        bands = np.array_split(np.arange(n_perm), n_perm - min_count + 1)
+        with ThreadPoolExecutor(_n_threads(n_threads)) as executor:
+            # Near a low threshold, most pairs share a band, and comparing all pairs in tiles is faster
+            n_candidates = sum(int(np.sum(sizes * (sizes - 1) // 2))
+                               for _, _, sizes in map(lambda band: _band_groups(capital_f, band), bands))
+            if n_candidates * _CLUSTER_CANDIDATE_RATIO > n_distinct * (n_distinct - 1) // 2:
+                parents = _link_tiles(capital_f, np.arange(n_distinct), min_count, parents, executor)
+            else:
+                for band in tqdm(bands, delay=1, desc='Computing Jaccard clusters'):
+                    parents = _link_band(capital_f, band, min_count, parents, executor)
+
+    # Map the clusters of the distinct fingerprints back to the first original fingerprint in each cluster
+    cluster_first_ids = np.full(n_distinct, len(inverse))
+    np.minimum.at(cluster_first_ids, parents, first_ids)
+    return cluster_first_ids[parents][inverse]
+
+
+def _band_groups(capital_f, band):
+    """
+    Groups the fingerprints by (a hash of) their band columns. Returns the
+    fingerprint ids in group order with the start and the size of each group.
+    """
+    band_hashes = np.zeros(len(capital_f), dtype=np.uint64)
+    for column in band:
+        band_hashes *= np.uint64(0x100000001b3)
+        band_hashes ^= capital_f[:, column].astype(np.uint64)
+    order = np.argsort(band_hashes, kind='stable')
+    sorted_hashes = band_hashes[order]
+    starts = np.flatnonzero(np.append(True, sorted_hashes[1:] != sorted_hashes[:-1]))
+    return order, starts, np.diff(np.append(starts, len(order)))
+
+
+def _link_band(capital_f, band, min_count, parents, executor):
+    """
+    Links the pairs with at least min_count equal columns which agree on a
+    band (hash collisions are filtered when comparing). Returns the
+    compressed union-find forest.
+    """
+    order, starts, sizes = _band_groups(capital_f, band)
+    # The large groups are compared in tiles
+    for start, size in zip(starts[sizes > _CLUSTER_TILE_GROUP_SIZE], sizes[sizes > _CLUSTER_TILE_GROUP_SIZE]):
+        parents = _link_tiles(capital_f, order[start:start + size], min_count, parents, executor)
+
+    # In the small groups, each fingerprint is compared with the next ones which are not in the same cluster yet
+    small = np.repeat(sizes <= _CLUSTER_TILE_GROUP_SIZE, sizes)
+    group_ends = np.repeat(starts + sizes, sizes)
+    positions = np.flatnonzero(small & (sizes[np.repeat(np.arange(len(sizes)), sizes)] > 1))
+    distance = 1
+    while len(positions) > 0:
+        positions = positions[positions + distance < group_ends[positions]]
+        i, j = order[positions], order[positions + distance]
+        unlinked = parents[i] != parents[j]
+        i, j = i[unlinked], j[unlinked]
+        matched = _verify_pairs(capital_f, i, j, min_count, executor)
+        if np.any(matched):
+            parents = _link(parents, i[matched], j[matched])
+        distance += 1
+    return parents
+
+
+def _link_tiles(capital_f, ids, min_count, parents, executor):
+    """
+    Links all pairs of the fingerprints ids with at least min_count equal
+    columns, compared in blocks of rows of the upper triangle. Returns the
+    compressed union-find forest.
+    """
+    capital_f_ids = capital_f[ids]
+    n_ids = len(ids)
+    # Blocks of rows with (uint16) equal counts of the next fingerprints in _SIMILARITY_BLOCK_SIZE bytes
+    block_size = max(1, _SIMILARITY_BLOCK_SIZE // (2 * max(n_ids, 1)))
+    for start in range(0, n_ids, block_size):
+        counts = _equal_counts(capital_f_ids[start:start + block_size], capital_f_ids[start:], executor)
+        rows, columns = np.nonzero(counts >= min_count)
+        upper = columns > rows
+        i, j = ids[start + rows[upper]], ids[start + columns[upper]]
+        unlinked = parents[i] != parents[j]
+        if np.any(unlinked):
+            parents = _link(parents, i[unlinked], j[unlinked])
+    return parents
+
+
+def _verify_pairs(capital_f, i, j, min_count, executor):
+    """
+    Returns a mask of the (i, j) fingerprint pairs with at least min_count
+    equal columns, compared in blocks by the threads of executor.
+    """
+    matched = np.zeros(len(i), dtype=bool)
+
+    def verify_block(start):
+        block = slice(start, start + _VERIFY_BLOCK_SIZE)
+        matched[block] = np.count_nonzero(capital_f[i[block]] == capital_f[j[block]], axis=1) >= min_count
+
+    list(executor.map(verify_block, range(0, len(i), _VERIFY_BLOCK_SIZE)))
+    return matched
+
+
+def _find_roots(parents):
+    """
+    Returns the root of each node of a union-find forest (pointer jumping)
+    """
+    while True:
+        grandparents = parents[parents]
+        if np.array_equal(grandparents, parents):
+            return parents
+        parents = grandparents
+
+
+def _link(parents, i, j):
+    """
+    Merges the clusters of the (i, j) pairs in a compressed union-find forest,
+    the root of each merged cluster is its smallest root. Returns the
+    compressed forest.
+    """
+    while len(i) > 0:
+        root_i, root_j = parents[i], parents[j]
+        unlinked = root_i != root_j
+        i, j, root_i, root_j = i[unlinked], j[unlinked], root_i[unlinked], root_j[unlinked]
+        np.minimum.at(parents, np.maximum(root_i, root_j), np.minimum(root_i, root_j))
+        parents = _find_roots(parents)
+    return parents
 
 
 def _cut_bytes(b, n=4, offset=0):
@@ -295,6 +640,35 @@ def byte_hashes(b, n=4):
     return h
 
 
+def byte_range_hashes(b, starts, ends, n=4, unique=False):
+    """
+    Breaks a bytestring into all overlapping character level n-grams at once
+    and returns the n-gram integers of each [start, end) byte range (e.g. the
+    windows of a whole file) as views of a single array. Same values as
+    byte_hashes(b[start:end], n) for each range, without a sort per range.
+
+    The n-grams of a range are deduplicated only if unique is True, as
+    fingerprints are the same with or without duplicates.
+
+    n must be equal to 1,2, or 4.
+    """
+    dtypes = {1: np.uint8, 2: np.uint16, 4: np.uint32}
+    if n not in dtypes:
+        raise ValueError('n must be in [1,2,4]')
+    b_view = np.frombuffer(b, dtype=np.uint8)
+    if len(b_view) < n:
+        h = np.zeros(0, dtype=dtypes[n])
+    else:
+        # The n-gram starting at each byte (the same native byte order as _cut_bytes)
+        h = np.ascontiguousarray(np.lib.stride_tricks.sliding_window_view(b_view, n)).view(dtypes[n])[:, 0]
+    # A range of l bytes has l - n + 1 n-grams
+    ends = np.maximum(np.asarray(ends) - n + 1, starts)
+    hs = [h[start:end] for start, end in zip(np.asarray(starts).tolist(), ends.tolist())]
+    if unique:
+        hs = [np.unique(h_range) for h_range in hs]
+    return hs
+
+
 def token_hashes(tokens, n=1):
     """
     Converts a sequence of string tokens into ngrams and then hashes each ngram
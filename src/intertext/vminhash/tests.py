@@ -167,3 +167,77 @@ plt.plot([0,cardResultsDF['log_cardinality'].max()],[0,cardResultsDF['log_cardin
 
 sb.lmplot(x='cardinality',y='estimate',hue='n_perm',data=cardResultsDF,fit_reg=False)
 plt.plot([0,cardResultsDF['cardinality'].max()],[0,cardResultsDF['cardinality'].max()],lw=0.5,c='k')
+
+
+
+def hashFamilyAccuracyTest(set_size=1000,n_fractions=51,n_perm_values=(64,128,256),seed=0):
+
+    # Pairs of random hash sets with known overlap (and thus known jaccard similarity)
+    generator = np.random.RandomState(seed)
+    values = np.unique(generator.randint(0,2**32,size=4*set_size,dtype=np.uint64))
+    values = generator.permutation(values)[:3*set_size].astype(np.uint32)
+    overlaps = np.linspace(0,set_size,n_fractions).astype(int)
+
+    results = []
+    for hash_family in ['universal','multiply_shift']:
+        for one_permutation in False,True:
+            for mirror in False,True:
+                for n_perm in n_perm_values:
+                    hasher = VectorizedMinHash(n_perm,mirror=mirror,hash_family=hash_family,
+                                               one_permutation=one_permutation)
+
+                    for overlap in overlaps:
+                        h0 = values[:set_size]
+                        h1 = values[set_size-overlap:2*set_size-overlap]
+                        true_jaccard = overlap / (2*set_size - overlap)
+
+                        start_time = time.time()
+                        f0, f1 = hasher.fingerprints([h0,h1],cuda=False)
+                        end_time = time.time()
+
+                        results.append({'hash_family':hash_family,'one_permutation':one_permutation,
+                                        'n_perm':n_perm,'mirror':mirror,
+                                        'true_jaccard':true_jaccard,'jaccard':jaccard(f0,f1),
+                                        'time':(end_time-start_time)/2})
+
+    df = pd.DataFrame(results)
+    df['error'] = np.abs(df['jaccard'] - df['true_jaccard'])
+
+    return df
+
+
+hashResultsDF = hashFamilyAccuracyTest()
+
+# Both families (with or without OPH) should estimate the jaccard similarity with an expected error of O(1/sqrt(n_perm))
+hashErrorDF = hashResultsDF.groupby(['hash_family','one_permutation','mirror','n_perm'])[['error','time']].mean().reset_index()
+print(hashErrorDF)
+assert (hashErrorDF['error'] < 2/np.sqrt(hashErrorDF['n_perm'])).all()
+
+sb.lmplot(x='true_jaccard',y='jaccard',data=hashResultsDF[~hashResultsDF['mirror']],hue='n_perm',col='hash_family',row='one_permutation',fit_reg=False,size=4,aspect=1)
+plt.plot([0,1],[0,1],lw=0.5,c='k')
+
+
+# byte_range_hashes should give the same n-grams as byte_hashes for every range of a bytestring
+sampleBytes = sampleText.encode('UTF-8')
+for n in (1,2,4):
+    starts = np.random.randint(0,len(sampleBytes),size=100)
+    ends = starts + np.random.randint(0,200,size=100)
+    for start,end,h in zip(starts,ends,byte_range_hashes(sampleBytes,starts,ends,n=n,unique=True)):
+        assert np.array_equal(h,byte_hashes(sampleBytes[start:end],n=n))
+
+
+# The blocked CPU similarities should match jaccard_matrix, and clusters should be the connected components over the threshold
+# (seeded, and each slice has at least 50 bytes, so none is shorter than a shingle)
+sampleRandom = np.random.RandomState(40)
+sampleFingerprints = VectorizedMinHash(n_perm=128).fingerprints([byte_hashes(sampleBytes[i:i+sampleRandom.randint(50,500)])
+                                                                  for i in sampleRandom.randint(0,len(sampleBytes)-500,size=200)])
+sampleMatrix = jaccard_matrix(sampleFingerprints)
+assert np.array_equal(np.vstack(list(jaccard_similarities(sampleFingerprints,cuda=False))),sampleMatrix)
+for threshold in (0.3,0.6,0.9):
+    clusterIds = jaccard_cluster(sampleFingerprints,threshold=threshold,cuda=False)
+    linked = sampleMatrix >= threshold
+    assert (clusterIds[np.nonzero(linked)[0]] == clusterIds[np.nonzero(linked)[1]]).all()
+    for i,c in enumerate(clusterIds):
+        # each cluster is connected and its id is its first element
+        members = np.flatnonzero(clusterIds == c)
+        assert c == members[0] and (len(members) == 1 or linked[np.ix_(members,members)].sum(axis=1).min() > 1)
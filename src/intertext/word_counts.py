@@ -0,0 +1,97 @@
+import sys
+from uuid import uuid4
+from collections import Counter
+
+import numpy as np
+from bounter import bounter
+
+from utils import get_words, parallel_map
+
+# the files are counted in blocks of up to this many bytes of text (about a million words)
+BLOCK_BYTES = 2 ** 23
+# the memory of a vocabulary entry besides its string (the dict slot and the count)
+ENTRY_BYTES = 64
+
+
+# Only this function is public in this file!
+def get_word_counts(infiles, bounter_size, strip_diacritics):
+    """Return a WordCounts instance (exact if the vocabulary fits into bounter_size MB) if user requested likelihoods"""
+    print(' * computing word counts')
+    max_bytes = bounter_size * 2 ** 20
+    counts, counts_bytes = {}, 0
+    sketch = None
+    # count the words of the files in blocks in parallel and merge the per-block counts
+    for block_counts in parallel_map(count_words, get_file_blocks(infiles), strip_diacritics=strip_diacritics):
+        if sketch is not None:
+            sketch.update(block_counts)
+            continue
+        for word, count in block_counts.items():
+            if word in counts:
+                counts[word] += count
+            else:
+                counts[word] = count
+                counts_bytes += sys.getsizeof(word) + ENTRY_BYTES
+        # fall back to the bounter sketch if the vocabulary does not fit into the memory budget
+        if counts_bytes > max_bytes:
+            print(' * vocabulary is too large for exact word counts, using bounter instead')
+            sketch = bounter(size_mb=bounter_size)
+            sketch.update(counts)
+            counts = None
+    print(' * finished computing word counts')
+    if sketch is not None:
+        return WordCounts(sketch=sketch)
+    return WordCounts(counts=counts)
+
+
+def get_file_blocks(infiles):
+    """Yield blocks of files with up to BLOCK_BYTES bytes of text (or a single larger file)"""
+    block, block_bytes = [], 0
+    for infile in infiles:
+        size = infile.stat().st_size
+        if len(block) > 0 and block_bytes + size > BLOCK_BYTES:
+            yield block
+            block, block_bytes = [], 0
+        block.append(infile)
+        block_bytes += size
+    if len(block) > 0:
+        yield block
+
+
+def count_words(infiles, strip_diacritics):
+    """Return the counts of the distinct words of the files"""
+    counts = Counter()
+    for infile in infiles:
+        counts.update(get_words(infile, strip_diacritics, False))
+    return dict(counts)
+
+
+class WordCounts:
+    """Word probabilities in the corpus either from exact counts or from a bounter sketch"""
+    def __init__(self, counts=None, sketch=None):
+        # identifies the counts (also among the copies pickled to the worker processes) for caching
+        self._token = uuid4().hex
+        self._sketch = sketch
+        if sketch is None:
+            # turn the counts into probabilities in place, as the vocabulary may take most of bounter_size
+            total = max(sum(counts.values()), 1)
+            for word in counts:
+                counts[word] /= total
+            self._probabilities = counts
+        else:
+            self._total = sketch.total()
+
+    def probabilities(self, words):
+        """Return the array of probabilities of the words"""
+        if self._sketch is not None:
+            return np.array([self._sketch[w] / self._total for w in words], dtype=np.float64)
+        return np.fromiter((self._probabilities.get(w, 0.0) for w in words), dtype=np.float64, count=len(words))
+
+    def prefix_sums(self, words):
+        """Return the cumulative probabilities of the words, so the probability of words[i:j] is ret[j] - ret[i]"""
+        return np.concatenate(([0.0], np.cumsum(self.probabilities(words))))
+
+    def __hash__(self):
+        return hash(self._token)
+
+    def __eq__(self, other):
+        return isinstance(other, WordCounts) and self._token == other._token